@@ -0,0 +1,220 @@
+"""
+Read-only JSON API, version 1, for consumers that would otherwise scrape the HTML pages.
+
+    GET /api/v1/stories?after=<story id>&limit=<n>         a page of Stories
+    GET /api/v1/stories/<story id>                         a Story and its summary
+    GET /api/v1/stories/<story id>/edits?after=<edit cursor>&limit=<n>
+                                                           a page of a Story's Edits
+    GET /api/v1/stories/<story id>/export                  the Story and its Edits as NDJSON
+    GET /api/v1/export                                     every Story and its Edits as NDJSON
+
+As on the HTML pages, a Story's Edits are only readable by Users who have edited it:
+the Edits of any other Story are answered with 403 Forbidden,
+and the corpus export only has the Stories the logged in User has edited.
+
+Pages are keyset-paginated: each has a `next` cursor to pass as `after`,
+or null on the last page.
+NDJSON exports are streamed a page of Stories and Edits at a time, in constant memory:
+each Story is a {"type": "story", ...} line followed by its {"type": "edit", ...} lines.
+"""
+
+from datetime import datetime
+
+from flask import Blueprint, Response, json, jsonify, request, stream_with_context
+from typing import Any, Callable, Dict, Iterable, Iterator
+
+from storytelling_db import \
+    StoryTellingDatabase, \
+    Story, \
+    Edit, \
+    User, \
+    StorySummary, \
+    StoryTellingException, \
+    EDIT_PAGE_SIZE
+
+API_PREFIX = '/api/v1'
+
+"""Default and maximum number of items in a page."""
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = EDIT_PAGE_SIZE
+
+"""Number of Stories fetched at a time by the corpus export."""
+EXPORT_STORY_PAGE_SIZE = 500
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+Json = Dict[str, Any]
+
+
+class ApiError(Exception):
+    """An error response of the API, with an HTTP status."""
+
+    def __init__(self, message, status=400):
+        # type: (str, int) -> None
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+def format_time(time):
+    # type: (datetime | None) -> unicode | None
+    return None if time is None else time.isoformat()
+
+
+def user_json(user):
+    # type: (User) -> Json
+    return dict(id=user.id, username=user.username)
+
+
+def story_json(story):
+    # type: (Story) -> Json
+    return dict(id=story.id, storyname=story.storyname)
+
+
+def summary_json(story, summary, start_time):
+    # type: (Story, StorySummary | None, datetime) -> Json
+    fields = story_json(story)
+    fields.update(
+        start_time=format_time(start_time),
+        edit_count=summary.edit_count if summary else 0,
+        last_edit_time=format_time(summary.last_edit_time) if summary else None,
+        last_editor=user_json(summary.last_editor) if summary else None,
+    )
+    return fields
+
+
+def edit_json(edit):
+    # type: (Edit) -> Json
+    return dict(story_id=edit.story.id, user=user_json(edit.user), text=edit.text,
+                time=format_time(edit.time))
+
+
+def get_int_arg(name, default, minimum=0, maximum=None):
+    # type: (str, int, int, int | None) -> int
+    """Get an integer query string argument, raising an ApiError if it's invalid."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError('{} must be an integer'.format(name))
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ApiError('{} must be between {} and {}'.format(name, minimum, maximum))
+    return value
+
+
+def get_page_size():
+    # type: () -> int
+    return get_int_arg('limit', DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+
+
+def ndjson_lines(objs):
+    # type: (Iterable[Json]) -> Iterator[str]
+    for obj in objs:
+        yield json.dumps(obj) + '\n'
+
+
+def make_api(db, current_user):
+    # type: (StoryTellingDatabase, Callable[[], User | None]) -> Blueprint
+    """
+    Make the API's Blueprint, to be registered at `API_PREFIX`,
+    reading from `db` and answering 401 unless `current_user()` is a User.
+    """
+    api = Blueprint('api', __name__)
+
+    @api.errorhandler(ApiError)
+    def api_error(e):
+        # type: (ApiError) -> Response
+        response = jsonify(error=e.message)
+        response.status_code = e.status
+        return response
+
+    @api.before_request
+    def check_authorized():
+        if current_user() is None:
+            raise ApiError('not logged in', 401)
+
+    def get_story(story_id):
+        # type: (int) -> Story
+        try:
+            return db.get_story_by_id(story_id)
+        except StoryTellingException as e:
+            raise ApiError(e.message, 404)
+
+    def get_readable_story(story_id):
+        # type: (int) -> Story
+        """Get a Story whose Edits the current User may read, i.e. has edited."""
+        story = get_story(story_id)
+        if db.can_edit(story, current_user()):
+            raise ApiError('edit the story before reading its edits', 403)
+        return story
+
+    @api.route('/stories')
+    def stories():
+        # type: () -> Response
+        after = get_int_arg('after', 0)
+        limit = get_page_size()
+        with db:
+            page = list(db.get_stories(after, limit))
+        return jsonify(stories=map(story_json, page),
+                       next=page[-1].id if len(page) == limit else None)
+
+    @api.route('/stories/<int:story_id>')
+    def story(story_id):
+        # type: (int) -> Response
+        with db:
+            story = get_story(story_id)
+            return jsonify(summary_json(story, db.get_summary(story),
+                                        db.get_story_start_time(story)))
+
+    @api.route('/stories/<int:story_id>/edits')
+    def edits(story_id):
+        # type: (int) -> Response
+        after = get_int_arg('after', 0)
+        limit = get_page_size()
+        with db:
+            story = get_readable_story(story_id)
+            page, next_after = db.get_edit_page(story, after, limit)
+        return jsonify(edits=map(edit_json, page),
+                       next=next_after if len(page) == limit else None)
+
+    def export_story(story):
+        # type: (Story) -> Iterator[Json]
+        story_fields = story_json(story)
+        story_fields['type'] = 'story'
+        yield story_fields
+        for edit in db.iter_edits(story):
+            edit_fields = edit_json(edit)
+            edit_fields['type'] = 'edit'
+            yield edit_fields
+
+    def export_stories(user):
+        # type: (User) -> Iterator[Json]
+        after = 0
+        while True:
+            with db:
+                page = list(db.get_edited_stories(user, after, EXPORT_STORY_PAGE_SIZE))
+            for story in page:
+                for obj in export_story(story):
+                    yield obj
+            if len(page) < EXPORT_STORY_PAGE_SIZE:
+                return
+            after = page[-1].id
+
+    def ndjson_response(objs):
+        # type: (Iterator[Json]) -> Response
+        return Response(stream_with_context(ndjson_lines(objs)), mimetype=NDJSON_MIMETYPE)
+
+    @api.route('/stories/<int:story_id>/export')
+    def export_one(story_id):
+        # type: (int) -> Response
+        with db:
+            story = get_readable_story(story_id)
+        return ndjson_response(export_story(story))
+
+    @api.route('/export')
+    def export_all():
+        # type: () -> Response
+        return ndjson_response(export_stories(current_user()))
+
+    return api
@@ -5,8 +5,10 @@ from sys import stderr
 __authors__ = ['Khyber Sen', 'Caleb Smith-Salzburg', 'Michael Ruvinshteyn', 'Terry Guan']
 __date__ = '2017-10-30'
 
-from typing import Callable
+from typing import Callable, List
 import os
+from datetime import datetime
+from time import mktime
 
 from flask import \
     Flask, \
@@ -27,9 +29,22 @@ from util.flask_utils import \
     post_only, \
     reroute_to, \
     form_contains, \
+    values_contains, \
     session_contains, \
-    bind_args
-
+    bind_args, \
+    stream_template, \
+    not_modified, \
+    with_validators, \
+    time_requests, \
+    track_queries
+
+from util.db import DEFAULT_GROUP_COMMIT_INTERVAL
+from util.metrics import REGISTRY, CONTENT_TYPE, CallbackMetric, Histogram
+from util.sessions import \
+    ServerSideSessionInterface, \
+    MemorySessionStore, \
+    SqliteSessionStore, \
+    DEFAULT_SESSION_TTL
 from util.template_context import add_template_context
 from util.flask_json import use_named_tuple_json
 
@@ -39,16 +54,71 @@ from storytelling_db import \
     Story, \
     Edit, \
     StoryTellingException
+from story_fragments import StoryFragmentCache
+from api import make_api, API_PREFIX
 
 app = Flask(__name__)
 
-db = StoryTellingDatabase()
+"""Path of the database, overridable for benchmarks and tests."""
+DB_PATH = os.environ.get('STORYTELLING_DB', 'data/storytelling.db')
+
+"""Queries taking at least this many seconds are logged with their query plans."""
+SLOW_QUERY_THRESHOLD = 0.1
+
+db = StoryTellingDatabase(DB_PATH, group_commit_interval=DEFAULT_GROUP_COMMIT_INTERVAL,
+                          slow_query_threshold=SLOW_QUERY_THRESHOLD)
+
+"""
+Sessions are kept server-side, the cookie only holds the session id.
+If STORYTELLING_SESSIONS is set, they're persisted in that SQLite database,
+otherwise kept in memory.
+"""
+SESSIONS_PATH = os.environ.get('STORYTELLING_SESSIONS')
+SESSION_TTL = DEFAULT_SESSION_TTL
+
+app.session_interface = ServerSideSessionInterface(
+    SqliteSessionStore(SESSIONS_PATH, SESSION_TTL) if SESSIONS_PATH
+    else MemorySessionStore(SESSION_TTL))
+
+REQUEST_SECONDS = Histogram('storytelling_request_seconds',
+                            'Seconds taken by each request', ['route'])
+time_requests(app, REQUEST_SECONDS)
+
+"""Metrics read from db.stats() when scraped: name, documentation, stat, type."""
+DB_METRICS = [
+    ('storytelling_db_connections', 'Pooled read connections open', 'connections', 'gauge'),
+    ('storytelling_db_pool_checkouts_total', 'Pooled connection checkouts', 'checkouts',
+     'counter'),
+    ('storytelling_db_pool_waits_total', 'Checkouts that waited for a free connection', 'waits',
+     'counter'),
+    ('storytelling_db_pool_wait_seconds_total', 'Seconds waited for a free connection',
+     'wait_time', 'counter'),
+    ('storytelling_db_write_lock_waits_total', 'Writes that waited for the write lock',
+     'write_waits', 'counter'),
+    ('storytelling_db_write_lock_wait_seconds_total', 'Seconds waited for the write lock',
+     'write_wait_time', 'counter'),
+    ('storytelling_db_transactions_total', 'Committed write transactions', 'transactions',
+     'counter'),
+    ('storytelling_db_queries_total', 'SQL statements executed', 'queries', 'counter'),
+]
+
+for name, documentation, stat, type in DB_METRICS:
+    CallbackMetric(name, documentation, lambda stat=stat: db.stats()[stat], type)
+
+"""Rendered Edits of the stories read, extended as they're edited."""
+fragment_cache = StoryFragmentCache(db, app.jinja_env)
+db.caches.append(fragment_cache)
+
+CallbackMetric('storytelling_fragment_cache_bytes', 'Bytes of rendered Edits cached',
+               lambda: fragment_cache.stats()['bytes'])
 
 """Keys in session."""
 USER_KEY = 'user'
 STORY_KEY = 'story'
 EDIT_KEY = 'edit'
 IS_NEW_STORY_KEY = 'is_new_story'
+"""Session key of the messages flashed by flash()."""
+FLASHES_KEY = '_flashes'
 
 
 def get_user():
@@ -84,6 +154,8 @@ def pop_edit():
 is_logged_in = session_contains(USER_KEY)  # type: Precondition
 is_logged_in.func_name = 'is_logged_in'
 
+app.register_blueprint(make_api(db, lambda: session.get(USER_KEY)), url_prefix=API_PREFIX)
+
 
 @app.reroute_from('/')
 @app.route('/welcome')
@@ -113,14 +185,15 @@ def auth_or_signup(db_user_supplier):
     if is_logged_in():
         reroute_to(home)
     username, password = get_user_info()
-    with db:
-        try:
-            user = db_user_supplier(username, password)
-        except StoryTellingException as e:
-            flash(e.message)
-            print(e, file=stderr)
-            return reroute_to(login)
-
+    # not `with db:`, so no pooled connection is held while the password is hashed
+    try:
+        user = db_user_supplier(username, password)
+    except StoryTellingException as e:
+        flash(e.message)
+        print(e, file=stderr)
+        return reroute_to(login)
+
+    session.regenerate()  # against session fixation
     session[USER_KEY] = user
     return reroute_to(home)
 
@@ -145,33 +218,126 @@ def auth():
     return auth_or_signup(db.get_user)
 
 
+def utc(local_time):
+    # type: (datetime | None) -> datetime | None
+    """Convert a naive local time, as stored in the DB, to naive UTC, as sent in HTTP headers."""
+    if local_time is None:
+        return None
+    return datetime.utcfromtimestamp(mktime(local_time.timetuple()))
+
+
+"""Number of Stories in each list on a page of /home."""
+HOME_PAGE_SIZE = 50
+
+
+def get_cursor(name):
+    # type: (str) -> int
+    """Get keyset cursor (the last id of the previous page) from request.args."""
+    return request.args.get(name, default=0, type=int)
+
+
+def paginate(stories):
+    # type: (List[Story]) -> (List[Story], int | None)
+    """
+    Split Stories fetched with a limit of HOME_PAGE_SIZE + 1
+    into a page and the cursor of the next page (None if this is the last).
+    """
+    if len(stories) > HOME_PAGE_SIZE:
+        page = stories[:HOME_PAGE_SIZE]
+        return page, page[-1].id
+    return stories, None
+
+
 @app.route('/home')
 @logged_in
 def home():
     # type: () -> Response
-    """Display a User's home page with all of his edited and unedited Stories."""
+    """
+    Display a page of a User's home page with his edited and unedited Stories.
+    Each list is paginated separately by the edited_after and unedited_after cursors.
+
+    Every Story created or edited is a new version of the page, identified by its ETag,
+    so a client with the current version gets a 304 Not Modified.
+    Pages showing flashed messages aren't reusable, since messages are only shown once.
+    """
     user = get_user()
+    edited_after = get_cursor('edited_after')
+    unedited_after = get_cursor('unedited_after')
+    conditional = FLASHES_KEY not in session
     with db:
-        return render_template('home.jinja2',
+        if conditional:
+            version, time = db.get_version()
+            etag = 'home-{}-{}'.format(user.id, version)
+            last_modified = utc(time)
+            response = not_modified(etag, last_modified)
+            if response is not None:
+                return response
+        edited_stories, next_edited_after = paginate(list(
+            db.get_edited_stories(user, edited_after, HOME_PAGE_SIZE + 1)))
+        unedited_stories, next_unedited_after = paginate(list(
+            db.get_unedited_stories(user, unedited_after, HOME_PAGE_SIZE + 1)))
+        page = render_template('home.jinja2',
                                user=user,
-                               edited_stories=sorted(db.get_edited_stories(user)),
-                               unedited_stories=sorted(db.get_unedited_stories(user)),
+                               edited_stories=edited_stories,
+                               unedited_stories=unedited_stories,
+                               edited_after=edited_after,
+                               unedited_after=unedited_after,
+                               next_edited_after=next_edited_after,
+                               next_unedited_after=next_unedited_after,
+                               summaries=db.get_summaries(edited_stories + unedited_stories),
                                )
+    if conditional:
+        return with_validators(page, etag, last_modified)
+    return page
+
+
+"""Number of Stories on a page of /search."""
+SEARCH_PAGE_SIZE = 20
+
+
+@app.route('/search')
+@logged_in
+def search():
+    # type: () -> Response
+    """Display a page of Stories matching the words in the query, best matches first."""
+    query = request.args.get('q', default=u'')
+    page = max(request.args.get('page', default=0, type=int), 0)
+    stories = []  # type: List[Story]
+    has_next_page = False
+    if query:
+        with db:
+            try:
+                stories = db.search(query, page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE + 1)
+            except StoryTellingException as e:
+                flash(e.message)
+                print(e, file=stderr)
+        has_next_page = len(stories) > SEARCH_PAGE_SIZE
+        stories = stories[:SEARCH_PAGE_SIZE]
+    return render_template('search.jinja2',
+                           query=query,
+                           page=page,
+                           stories=stories,
+                           has_next_page=has_next_page)
 
 
 @app.route('/story', methods=['get', 'post'])
 @logged_in
-@preconditions(home, post_only, form_contains('story'))
+@preconditions(home, values_contains('story'))
 def read_or_edit_story():
     # type: () -> Response
     """
-    Open Story specified through form for either reading or editing,
+    Open Story specified through the query string or form for either reading or editing,
     depending on if the User has edited the Story yet.
 
+    The read page of each version of a Story (i.e. its last Edit) has its own ETag,
+    so a client with the current version gets a 304 Not Modified
+    without the Edits being fetched or rendered,
+    unless the page shows flashed messages, as in home().
+
     If the story_id, storyname pair cannot be verified,
     reroute to home.
     """
-    storyname = request.form['story']
+    storyname = request.values['story']
 
     with db:
         try:
@@ -186,9 +352,28 @@ def read_or_edit_story():
         if editing:
             return render_template('edit_story.jinja2',
                                    last_edit=db.get_last_edit(story))
+        conditional = FLASHES_KEY not in session
+        version = None
+        if conditional:
+            version, time = db.get_story_version(story)
+            etag = 'story-{}-{}'.format(story.id, version)
+            last_modified = utc(time)
+            response = not_modified(etag, last_modified)
+            if response is not None:
+                return response
+        fragments = fragment_cache.get(story, version)
+        if fragments is not None:
+            page = render_template('read_story.jinja2', story=story, cached=fragments)
         else:
-            return render_template('read_story.jinja2',
-                                   edits=sorted(db.get_edits(story), key=Edit.order))
+            # too large to cache, so edits are fetched a page at a time as the response streams,
+            # once for the text and once for the table
+            page = stream_template('read_story.jinja2',
+                                   story=story,
+                                   texts=db.iter_edits(story),
+                                   edits=db.iter_edits(story))
+        if conditional:
+            return with_validators(page, etag, last_modified)
+        return page
 
 
 @app.route('/edit', methods=['get', 'post'])
@@ -201,19 +386,20 @@ def edit_story():
     Edit the Story the User already selected with the text passed through the POST form.
     Reroute to edited_story to display post-edit page, passing Edit and not is_new_story.
 
-    Check again if User can edit the Story.  If not, reroute to home.
+    If the User already edited the Story, e.g. in another tab, reroute to home.
     """
 
     story = get_story()
     user = get_user()
 
-    with db:
-        if not db.can_edit(story, user):
-            return reroute_to(home)
-
     text = request.form['text']
     with db:
-        edit = db.edit_story(story, user, text)
+        try:
+            edit = db.edit_story(story, user, text)
+        except StoryTellingException as e:
+            flash(e.message)
+            print(e, file=stderr)
+            return reroute_to(home)
     return reroute_to(edited_story, pop_story(), edit, False)
 
 
@@ -265,6 +451,13 @@ def edited_story(story, edit, is_new_story):
                            is_new_story=is_new_story)
 
 
+@app.route('/metrics')
+def metrics():
+    # type: () -> Response
+    """Expose the metrics in REGISTRY in the Prometheus text format."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/logout')
 def logout():
     # type: () -> Response
@@ -277,4 +470,5 @@ if __name__ == '__main__':
     app.secret_key = os.urandom(32)
     add_template_context(app)
     use_named_tuple_json(app)
+    track_queries(app, db.db)
     app.run()
@@ -0,0 +1,364 @@
+"""
+Online backups of a live database, and restoring and verifying them.
+
+A backup copies a consistent snapshot of the database while the app keeps serving:
+it's taken in a single read transaction on the source, which, in WAL mode,
+never blocks the app's readers or writer.
+Rows are copied `step_rows` at a time with a `step_sleep` pause between steps,
+so the backup doesn't starve requests of disk and CPU.
+(Python 2's sqlite3 has no `Connection.backup()`, and the backup API restarts
+whenever another connection writes to the source, so rows are copied with SQL instead,
+rowids, search index shadow tables and all.)
+Indexes and triggers are created once the rows are copied.
+
+The snapshot is held for the whole copy, so the source's WAL can't be checkpointed
+past it and grows with every write the app makes meanwhile.
+Its size is reported whenever it doubles past `WAL_REPORT_BYTES`,
+and the backup is abandoned (releasing the snapshot) if it exceeds `max_wal_bytes`.
+Copying in several shorter transactions would bound it too,
+but the backup would then mix states of the database, e.g. edits without their story_summary.
+
+Backups ending in .gz are gzip-compressed.
+A backup is written to a temporary file and renamed when complete,
+so an interrupted backup never leaves a partial file at its path.
+
+Usage:
+    python backup.py backup data/storytelling.db backups/storytelling.db.gz
+    python backup.py verify backups/storytelling.db.gz
+    python backup.py restore backups/storytelling.db.gz data/storytelling.db
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+from sys import stderr
+from timeit import default_timer as timer
+
+from typing import Callable, Dict, List, Tuple
+
+"""Rows copied per step and seconds slept between steps."""
+DEFAULT_STEP_ROWS = 10000
+DEFAULT_STEP_SLEEP = 0.01
+
+"""Seconds to wait for a lock on the source database."""
+BUSY_TIMEOUT = 30
+
+"""Source WAL size first reported while backing up, and the size abandoning the backup."""
+WAL_REPORT_BYTES = 64 << 20
+DEFAULT_MAX_WAL_BYTES = 1 << 30
+
+COPY_CHUNK_SIZE = 1 << 20
+GZIP_MAGIC = '\x1f\x8b'
+
+Progress = Callable[[str, int, int], None]
+
+
+class BackupException(Exception):
+    """A backup couldn't be made, restored or verified."""
+    pass
+
+
+def _quote(name):
+    # type: (unicode) -> unicode
+    return u'"{}"'.format(name.replace(u'"', u'""'))
+
+
+def _tables(conn, schema):
+    # type: (sqlite3.Connection, str) -> List[Tuple[unicode, unicode, bool]]
+    """The (name, type, without rowid) of each table, shadow and virtual table in `schema`."""
+    return [(name, type, bool(without_rowid))
+            for _, name, type, _, without_rowid, _ in conn.execute(
+                'PRAGMA {}.table_list'.format(schema))
+            if type in ('table', 'shadow', 'virtual') and not name.startswith('sqlite_')]
+
+
+def _schema_sql(conn, schema, types):
+    # type: (sqlite3.Connection, str, Tuple[str, ...]) -> List[Tuple[unicode, unicode]]
+    """The (name, sql) creating each object of the given types in `schema`, in creation order."""
+    return list(conn.execute(
+        'SELECT name, sql FROM {}.sqlite_master WHERE type IN ({}) AND sql IS NOT NULL '
+        'ORDER BY rowid'.format(schema, ', '.join('?' * len(types))), types))
+
+
+class _WalMonitor(object):
+    """Watches the size of the source's WAL while the backup holds its snapshot."""
+
+    def __init__(self, source_path, max_wal_bytes):
+        # type: (str, int) -> None
+        self.wal_path = source_path + '-wal'
+        self.max_wal_bytes = max_wal_bytes
+        self.report_bytes = WAL_REPORT_BYTES
+
+    def check(self):
+        # type: () -> None
+        """Report the WAL's size if it doubled, or raise a BackupException if it's too large."""
+        try:
+            size = os.path.getsize(self.wal_path)
+        except OSError:
+            return  # not in WAL mode, or checkpointed and truncated
+        if size > self.max_wal_bytes:
+            raise BackupException(
+                '{} grew to {:.0f} MB during the backup, over the maximum of {:.0f} MB'.format(
+                    self.wal_path, size / 1e6, self.max_wal_bytes / 1e6))
+        if size >= self.report_bytes:
+            print('{} is {:.0f} MB, held by the backup\'s snapshot'.format(
+                self.wal_path, size / 1e6), file=stderr)
+            while self.report_bytes <= size:
+                self.report_bytes *= 2
+
+
+def _copy_table(conn, name, without_rowid, step_rows, step_sleep, progress, wal_monitor):
+    # type: (sqlite3.Connection, unicode, bool, int, float, Progress, _WalMonitor) -> int
+    """Copy the rows of a table from `source` to `main`, `step_rows` at a time."""
+    table = _quote(name)
+    columns = u', '.join(_quote(column) for _, column, _, _, _, _ in conn.execute(
+        u'PRAGMA source.table_info({})'.format(table)))
+    total = conn.execute(u'SELECT count(*) FROM source.{}'.format(table)).fetchone()[0]
+    if without_rowid:
+        # only small shadow tables of the search index, copied at once
+        conn.execute(u'INSERT INTO main.{0} ({1}) SELECT {1} FROM source.{0}'
+                     .format(table, columns))
+        progress(name, total, total)
+        return total
+    insert = (u'INSERT INTO main.{0} (rowid, {1}) SELECT rowid, {1} FROM source.{0} '
+              u'WHERE rowid > ? ORDER BY rowid LIMIT ?'.format(table, columns))
+    copied = 0
+    last_rowid = None
+    while copied < total:
+        cursor = conn.execute(insert, [-(1 << 63) if last_rowid is None else last_rowid,
+                                       step_rows])
+        if cursor.rowcount <= 0:
+            break
+        copied += cursor.rowcount
+        last_rowid = conn.execute(u'SELECT max(rowid) FROM main.{}'.format(table)).fetchone()[0]
+        progress(name, copied, total)
+        wal_monitor.check()
+        time.sleep(step_sleep)
+    return copied
+
+
+def _snapshot(source_path, path, step_rows, step_sleep, progress, max_wal_bytes):
+    # type: (str, str, int, float, Progress, int) -> Dict[unicode, int]
+    """
+    Copy a consistent snapshot of `source_path` into a new database at `path`,
+    in a single read transaction, abandoned if the source's WAL exceeds `max_wal_bytes`.
+    """
+    wal_monitor = _WalMonitor(source_path, max_wal_bytes)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        # a new file, deleted if the backup fails, so it needs no journal
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('ATTACH DATABASE ? AS source', [source_path])
+        conn.execute('BEGIN')
+        # the first read starts the source's snapshot, held until COMMIT
+        user_version = conn.execute('PRAGMA source.user_version').fetchone()[0]
+        tables = _tables(conn, 'source')
+        shadow_tables = [name for name, type, _ in tables if type == 'shadow']
+        for name, sql in _schema_sql(conn, 'source', ('table',)):
+            if name not in shadow_tables:  # created by their virtual tables
+                conn.execute(sql)
+        for name in shadow_tables:
+            conn.execute(u'DELETE FROM main.{}'.format(_quote(name)))
+        counts = {}  # type: Dict[unicode, int]
+        for name, type, without_rowid in tables:
+            if type != 'virtual':
+                counts[name] = _copy_table(conn, name, without_rowid,
+                                           step_rows, step_sleep, progress, wal_monitor)
+        if conn.execute("SELECT 1 FROM source.sqlite_master WHERE name = 'sqlite_sequence'") \
+                .fetchone():
+            conn.execute('DELETE FROM main.sqlite_sequence')
+            conn.execute('INSERT INTO main.sqlite_sequence SELECT * FROM source.sqlite_sequence')
+        for _, sql in _schema_sql(conn, 'source', ('index', 'view', 'trigger')):
+            conn.execute(sql)
+        conn.execute('PRAGMA main.user_version = {:d}'.format(user_version))
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE source')
+    finally:
+        conn.close()
+    return counts
+
+
+def _temporary_path(path):
+    # type: (str) -> str
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                     dir=directory)
+    os.close(fd)
+    os.remove(temp_path)  # sqlite3 creates it
+    return temp_path
+
+
+def _remove(path):
+    # type: (str) -> None
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _report(name, copied, total):
+    # type: (str, int, int) -> None
+    print('\r{:<28} {:>10} / {:<10}'.format(name, copied, total),
+          end='\n' if copied >= total else '')
+
+
+def backup(source_path, backup_path, step_rows=DEFAULT_STEP_ROWS,
+           step_sleep=DEFAULT_STEP_SLEEP, progress=None, max_wal_bytes=DEFAULT_MAX_WAL_BYTES):
+    # type: (str, str, int, float, Progress | None, int) -> Dict[unicode, int]
+    """
+    Back up the database at `source_path` to `backup_path` (gzipped if it ends in .gz),
+    returning the number of rows copied by table.
+    If the source's WAL exceeds `max_wal_bytes` meanwhile, raise a BackupException.
+    """
+    if not os.path.exists(source_path):
+        raise BackupException('{} doesn\'t exist'.format(source_path))
+    progress = progress or (lambda name, copied, total: None)
+    compress = backup_path.endswith('.gz')
+    temp_path = _temporary_path(backup_path)
+    snapshot_path = _temporary_path(backup_path) if compress else temp_path
+    try:
+        counts = _snapshot(source_path, snapshot_path, step_rows, step_sleep, progress,
+                           max_wal_bytes)
+        if compress:
+            with open(snapshot_path, 'rb') as snapshot, gzip.open(temp_path, 'wb') as out:
+                shutil.copyfileobj(snapshot, out, COPY_CHUNK_SIZE)
+        with open(temp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.rename(temp_path, backup_path)
+    finally:
+        _remove(temp_path)
+        _remove(snapshot_path)
+    return counts
+
+
+def _decompress(backup_path, path):
+    # type: (str, str) -> None
+    """Copy a backup to `path`, decompressing it if it's gzipped."""
+    with open(backup_path, 'rb') as f:
+        compressed = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    try:
+        with (gzip.open if compressed else open)(backup_path, 'rb') as backup_file, \
+                open(path, 'wb') as out:
+            shutil.copyfileobj(backup_file, out, COPY_CHUNK_SIZE)
+            out.flush()
+            os.fsync(out.fileno())
+    except (IOError, zlib.error) as e:
+        raise BackupException('cannot read {}: {}'.format(backup_path, e))
+
+
+def check(path):
+    # type: (str) -> Dict[unicode, int]
+    """
+    Check a database's integrity, foreign keys and full-text search indexes,
+    raising a BackupException if any are broken, and return its row counts by table.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        try:
+            problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        except sqlite3.DatabaseError as e:
+            raise BackupException('not a database: {}'.format(e))
+        if problems != ['ok']:
+            raise BackupException('integrity check failed: ' + '; '.join(problems))
+        if conn.execute('PRAGMA foreign_key_check').fetchone() is not None:
+            raise BackupException('foreign key check failed')
+        for name, sql in _schema_sql(conn, 'main', ('table',)):
+            if 'USING fts5' in sql:
+                try:
+                    conn.execute(u'INSERT INTO {0}({0}, rank) VALUES (\'integrity-check\', 1)'
+                                 .format(_quote(name)))
+                except sqlite3.DatabaseError as e:
+                    raise BackupException(u'search index {} is corrupt: {}'.format(name, e))
+        conn.rollback()
+        return {name: conn.execute(u'SELECT count(*) FROM {}'.format(_quote(name))).fetchone()[0]
+                for name, type, _ in _tables(conn, 'main') if type == 'table'}
+    finally:
+        conn.close()
+
+
+def verify(backup_path):
+    # type: (str) -> Dict[unicode, int]
+    """Restore a backup to a temporary file and check it, returning its row counts by table."""
+    temp_path = _temporary_path(backup_path)
+    try:
+        _decompress(backup_path, temp_path)
+        return check(temp_path)
+    finally:
+        _remove(temp_path)
+
+
+def restore(backup_path, path, force=False):
+    # type: (str, str, bool) -> Dict[unicode, int]
+    """
+    Restore a backup to `path`, only once it's been checked, returning its row counts by table.
+    Unless `force`, an existing database at `path` isn't overwritten.
+    The app must not be running on `path`.
+    """
+    if os.path.exists(path) and not force:
+        raise BackupException('{} already exists'.format(path))
+    temp_path = _temporary_path(path)
+    try:
+        _decompress(backup_path, temp_path)
+        counts = check(temp_path)
+        _remove(path)  # including a stale -wal, which would be applied to the restored file
+        os.rename(temp_path, path)
+    finally:
+        _remove(temp_path)
+    return counts
+
+
+def print_counts(counts):
+    # type: (Dict[unicode, int]) -> None
+    for name in sorted(counts):
+        print('{:<28} {:>10}'.format(name, counts[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    backup_parser = commands.add_parser('backup', help='back up a live database')
+    backup_parser.add_argument('source', help='database to back up')
+    backup_parser.add_argument('backup', help='backup to write, gzipped if it ends in .gz')
+    backup_parser.add_argument('--step-rows', type=int, default=DEFAULT_STEP_ROWS,
+                               help='rows copied per step')
+    backup_parser.add_argument('--step-sleep', type=float, default=DEFAULT_STEP_SLEEP,
+                               help='seconds slept between steps')
+    backup_parser.add_argument('--max-wal-mb', type=float, default=DEFAULT_MAX_WAL_BYTES / 1e6,
+                               help='abandon the backup if the source\'s WAL grows past this')
+    verify_parser = commands.add_parser('verify', help='check a backup without restoring it')
+    verify_parser.add_argument('backup')
+    restore_parser = commands.add_parser('restore', help='check and restore a backup')
+    restore_parser.add_argument('backup')
+    restore_parser.add_argument('path', help='database to restore to')
+    restore_parser.add_argument('--force', action='store_true',
+                                help='overwrite an existing database')
+    args = parser.parse_args()
+
+    start = timer()
+    try:
+        if args.command == 'backup':
+            counts = backup(args.source, args.backup, args.step_rows, args.step_sleep, _report,
+                            int(args.max_wal_mb * 1e6))
+            print('backed up {} to {} ({} bytes)'.format(
+                args.source, args.backup, os.path.getsize(args.backup)))
+        elif args.command == 'verify':
+            counts = verify(args.backup)
+            print('{} is ok'.format(args.backup))
+        else:
+            counts = restore(args.backup, args.path, args.force)
+            print('restored {} to {}'.format(args.backup, args.path))
+    except BackupException as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+    print_counts(counts)
+    print('in {:.1f} s'.format(timer() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Size and encode/decode time of session values
+in `util.binary_codec` and Flask's tagged JSON (with the namedtuple JSON encoding).
+(The namedtuples can't be pickled, since they're created in `util.namedtuple_factory`.)
+
+Usage (from the repo root):
+    python -m benchmarks.codec [num_repeats]
+"""
+
+from __future__ import print_function
+
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from timeit import default_timer as timer
+
+from flask import Flask
+from flask.sessions import session_json_serializer
+from typing import Any, Callable
+
+from storytelling_db import User, Story, Edit
+from util import binary_codec
+from util.flask_json import use_named_tuple_json
+
+NUM_REPEATS = 20000
+
+SERIALIZERS = OrderedDict([
+    ('binary', binary_codec),
+    ('tagged json', session_json_serializer),
+])
+
+
+def values():
+    user = User(12345, u'storyteller')
+    story = Story(678, u'The Adventures of Sherlock Holmes')
+    edit = Edit(story, user, u'It was a dark and stormy night.', datetime(2017, 10, 30, 12, 0, 0))
+    return OrderedDict([
+        ('User', user),
+        ('Edit', edit),
+        ('session', {
+            'user': user,
+            'story': story,
+            'bound_args': {'3df3fe2911b8b8d7': ((story, edit, False), {})},
+            '_flashes': [('message', u'The story "X" already exists')],
+        }),
+    ])
+
+
+def time_per_call(func, arg, num_repeats):
+    # type: (Callable[[Any], Any], Any, int) -> float
+    start = timer()
+    for _ in xrange(num_repeats):
+        func(arg)
+    return (timer() - start) / num_repeats
+
+
+def main():
+    num_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_REPEATS
+    app = Flask(__name__)
+    use_named_tuple_json(app)
+    with app.app_context():  # the JSON serializer uses the app's JSON encoder
+        print('{:<8} {:<12} {:>6} {:>10} {:>10}'.format(
+            'value', 'codec', 'bytes', 'dumps us', 'loads us'))
+        for name, value in values().viewitems():
+            for codec_name, serializer in SERIALIZERS.viewitems():
+                encoded = serializer.dumps(value)
+                dumps_time = time_per_call(serializer.dumps, value, num_repeats)
+                loads_time = time_per_call(serializer.loads, encoded, num_repeats)
+                print('{:<8} {:<12} {:>6} {:>10.2f} {:>10.2f}'.format(
+                    name, codec_name, len(encoded), dumps_time * 1e6, loads_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
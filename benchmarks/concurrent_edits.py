@@ -0,0 +1,174 @@
+"""
+Concurrent stress test of editing stories: throughput and correctness
+of the atomic insert in `StoryTellingDatabase.edit_story`
+versus the previous check-then-insert (a scan of the story's editors
+before and again inside the write).
+
+Threads submit edits of the most edited stories of the `benchmarks.routes` dataset
+by new users, each (story, user) pair `duplicates` times in a shuffled order,
+so the same edit races itself across threads.
+Exactly one attempt of each pair must succeed and the rest raise a StoryTellingException,
+and the stories' summaries must match their edits.
+
+Usage (from the repo root):
+    python -m benchmarks.concurrent_edits [size] [num_threads]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.routes import ensure_dataset
+from storytelling_db import StoryTellingDatabase, StoryTellingException, Story, User, Edit
+from util.db import DEFAULT_GROUP_COMMIT_INTERVAL
+
+NUM_THREADS = 8
+NUM_STORIES = 20
+NUM_USERS = 20
+DUPLICATES = 3
+
+Attempt = Tuple[Story, User]
+EditFunction = Callable[[StoryTellingDatabase, Story, User, unicode], Edit]
+
+
+def check_then_insert(db, story, user, text):
+    # type: (StoryTellingDatabase, Story, User, unicode) -> Edit
+    """The previous write path: the route's check, then the check again inside the write."""
+
+    def check():
+        if any(editor.id == user.id for editor in db.get_editors(story)):
+            raise StoryTellingException('already edited this story ({})'.format(story.storyname))
+
+    with db:
+        check()
+
+    def write():
+        check()
+        return db._edit_story_hard(story, user, text)
+
+    return db._write(write)
+
+
+def atomic_insert(db, story, user, text):
+    # type: (StoryTellingDatabase, Story, User, unicode) -> Edit
+    with db:
+        return db.edit_story(story, user, text)
+
+
+MODES = OrderedDict([
+    ('check-then-insert', check_then_insert),
+    ('atomic insert', atomic_insert),
+])  # type: Dict[str, EditFunction]
+
+
+def setup(path):
+    # type: (str) -> Tuple[StoryTellingDatabase, List[Attempt]]
+    db = StoryTellingDatabase(path, group_commit_interval=DEFAULT_GROUP_COMMIT_INTERVAL)
+    users = [db.add_user(u'stress_user{}'.format(i), u'') for i in xrange(NUM_USERS)]
+    with db:
+        stories = [Story(story_id, storyname) for story_id, storyname in db.db.cursor.execute(
+            'SELECT stories.id, storyname FROM stories, story_summary '
+            'WHERE stories.id = story_id ORDER BY edit_count DESC LIMIT ?', [NUM_STORIES])]
+    attempts = [(story, user) for story in stories for user in users] * DUPLICATES
+    random.Random(0).shuffle(attempts)
+    return db, attempts
+
+
+def run(db, attempts, edit, num_threads):
+    # type: (StoryTellingDatabase, List[Attempt], EditFunction, int) -> Dict[str, float]
+    results = dict(edits=0, conflicts=0, errors=0)
+    lock = threading.Lock()
+
+    def worker(i):
+        counts = dict(edits=0, conflicts=0, errors=0)
+        for story, user in attempts[i::num_threads]:
+            try:
+                edit(db, story, user, u'stress edit by {}'.format(user.username))
+                counts['edits'] += 1
+            except StoryTellingException:
+                counts['conflicts'] += 1
+            except Exception as e:
+                print('error: {!r}'.format(e), file=sys.stderr)
+                counts['errors'] += 1
+        with lock:
+            for key, count in counts.viewitems():
+                results[key] += count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(num_threads)]
+    start = timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['seconds'] = timer() - start
+    results['queries'] = db.stats()['queries']
+    return results
+
+
+def check(db, attempts, results):
+    # type: (StoryTellingDatabase, List[Attempt], Dict[str, float]) -> List[str]
+    """The ways the results or the database are wrong, if any."""
+    pairs = set((story.id, user.id) for story, user in attempts)
+    problems = []
+    if results['edits'] != len(pairs):
+        problems.append('{} edits succeeded, expected {}'.format(results['edits'], len(pairs)))
+    if results['conflicts'] != len(attempts) - len(pairs):
+        problems.append('{} conflicts, expected {}'.format(
+            results['conflicts'], len(attempts) - len(pairs)))
+    if results['errors']:
+        problems.append('{} unexpected errors'.format(results['errors']))
+    with db:
+        cursor = db.db.cursor
+        cursor.execute("SELECT count(*) FROM edits WHERE text LIKE 'stress edit by %'")
+        num_edits = cursor.fetchone()[0]
+        if num_edits != len(pairs):
+            problems.append('{} edits in the database, expected {}'.format(num_edits, len(pairs)))
+        cursor.execute('''
+            SELECT count(*) FROM story_summary
+                WHERE edit_count != (SELECT count(*) FROM edits
+                                        WHERE edits.story_id = story_summary.story_id)''')
+        num_wrong = cursor.fetchone()[0]
+        if num_wrong:
+            problems.append('{} story summaries don\'t match their edits'.format(num_wrong))
+    return problems
+
+
+def main():
+    size = sys.argv[1] if len(sys.argv) > 1 else 'small'
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_THREADS
+    source = ensure_dataset(size)
+    tmp_dir = tempfile.mkdtemp()
+    failed = False
+    try:
+        for i, (mode, edit) in enumerate(MODES.viewitems()):
+            path = os.path.join(tmp_dir, 'concurrent-edits-{}.db'.format(i))
+            shutil.copy(source, path)
+            db, attempts = setup(path)
+            queries = db.stats()['queries']
+            results = run(db, attempts, edit, num_threads)
+            problems = check(db, attempts, results)
+            db.close()
+            print('{:<18} {:>5} attempts  {:>7.1f} attempts/s  {:>6.1f} queries/attempt  '
+                  '{} edits  {} conflicts  {}'.format(
+                      mode, len(attempts), len(attempts) / results['seconds'],
+                      float(results['queries'] - queries) / len(attempts),
+                      results['edits'], results['conflicts'],
+                      'ok' if not problems else 'FAILED: ' + '; '.join(problems)))
+            failed = failed or bool(problems)
+    finally:
+        shutil.rmtree(tmp_dir)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
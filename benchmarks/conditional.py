@@ -0,0 +1,97 @@
+"""
+Bytes and CPU time of repeat views of /home and /story (read),
+sent in full versus revalidated with If-None-Match and answered with 304 Not Modified.
+
+Uses a copy of the `benchmarks.routes` dataset of the given size.
+CPU time is the process time of the app and test client together.
+
+Usage (from the repo root):
+    python -m benchmarks.conditional [size] [num_requests]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+from typing import Callable, Dict, List
+
+from benchmarks.routes import storytelling_app, ensure_dataset, login, DEFAULT_REQUESTS
+from flask import Response
+from flask.testing import FlaskClient
+from story_fragments import StoryFragmentCache
+from storytelling_db import StoryTellingDatabase, User
+from util.flask_json import use_named_tuple_json
+from util.template_context import add_template_context
+
+"""Number of edited Stories whose read pages are viewed."""
+NUM_STORIES = 10
+
+
+def measure(get, urls, num_requests, etags=None):
+    # type: (Callable[..., Response], List[str], int, Dict[str, str] | None) -> Dict[str, float]
+    """Average bytes, CPU ms and wall ms per view, revalidating with `etags` if given."""
+    num_bytes = 0
+    cpu_start = time.clock()
+    start = timer()
+    for i in xrange(num_requests):
+        url = urls[i % len(urls)]
+        headers = {'If-None-Match': etags[url]} if etags is not None else {}
+        response = get(url, headers=headers)
+        num_bytes += len(response.get_data())
+        expected = 304 if etags is not None else 200
+        if response.status_code != expected:
+            raise RuntimeError('{} {}, expected {}'.format(url, response.status, expected))
+    return dict(
+        bytes=float(num_bytes) / num_requests,
+        cpu_ms=(time.clock() - cpu_start) * 1e3 / num_requests,
+        wall_ms=(timer() - start) * 1e3 / num_requests,
+    )
+
+
+def main():
+    size = sys.argv[1] if len(sys.argv) > 1 else 'small'
+    num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REQUESTS
+
+    flask_app = storytelling_app.app
+    flask_app.secret_key = 'benchmark'
+    flask_app.testing = True
+    add_template_context(flask_app)
+    use_named_tuple_json(flask_app)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'conditional.db')
+        shutil.copy(ensure_dataset(size), path)
+        storytelling_app.db.close()
+        db = StoryTellingDatabase(path)
+        storytelling_app.db = db
+        storytelling_app.fragment_cache = StoryFragmentCache(db, flask_app.jinja_env)
+        db.caches.append(storytelling_app.fragment_cache)
+
+        client = flask_app.test_client()  # type: FlaskClient
+        login(client, u'user1')
+        with db:
+            stories = list(db.get_edited_stories(User(1, u'user1'), 0, NUM_STORIES))
+        pages = [
+            ('/home', ['/home']),
+            ('/story (read)', ['/story?story={}'.format(story.storyname) for story in stories]),
+        ]
+        print('{:<14} {:<12} {:>10} {:>8} {:>8}'.format('page', 'view', 'bytes', 'cpu ms', 'ms'))
+        for name, urls in pages:
+            etags = {url: client.get(url).headers['ETag'] for url in urls}  # also warms up
+            for view, view_etags in (('full', None), ('revalidated', etags)):
+                result = measure(client.get, urls, num_requests, view_etags)
+                print('{:<14} {:<12} {bytes:>10.0f} {cpu_ms:>8.3f} {wall_ms:>8.3f}'.format(
+                    name, view, **result))
+        db.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
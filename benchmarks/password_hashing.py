@@ -0,0 +1,62 @@
+"""
+Throughput of hashing the passwords of bulk-added users
+(`PrivilegedStoryTellingDatabase.commit_added_users`) with 1, 2, 4, ... hash workers,
+up to the number of CPUs.
+
+Usage (from the repo root):
+    python -m benchmarks.password_hashing [num_users] [path]
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+from timeit import default_timer as timer
+
+from story_builder import PrivilegedStoryTellingDatabase
+
+
+def remove_db(path):
+    # type: (str) -> None
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def time_commit_added_users(path, num_users, hash_workers):
+    # type: (str, int, int) -> float
+    remove_db(path)
+    db = PrivilegedStoryTellingDatabase(path, hash_workers=hash_workers)
+    _ = db.users
+    _ = db.num_users
+    for i in xrange(num_users):
+        db.add_user(u'user{}'.format(i), u'')
+    start = timer()
+    db.commit_added_users()
+    db.commit()
+    elapsed = timer() - start
+    db.close()
+    remove_db(path)
+    return elapsed
+
+
+def main():
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    path = sys.argv[2] if len(sys.argv) > 2 else 'data/bench_password_hashing.db'
+    num_cpus = multiprocessing.cpu_count()
+    print('{} users, {} CPUs'.format(num_users, num_cpus))
+    workers = 1
+    single_worker_time = None
+    while True:
+        elapsed = time_commit_added_users(path, num_users, workers)
+        single_worker_time = single_worker_time or elapsed
+        print('{:3} workers: {:8.0f} users/s  ({:.2f}x)'.format(
+            workers, num_users / elapsed, single_worker_time / elapsed))
+        if workers >= num_cpus:
+            break
+        workers = min(workers * 2, num_cpus)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Before/after query plans and timings for the indexes added by `MIGRATIONS`.
+
+Builds a database with only the original `DB_SCHEMA` (no indexes),
+times the original queries, then opens it with `StoryTellingDatabase`
+(which applies the migrations) and times the current queries.
+
+Usage (from the repo root):
+    python -m benchmarks.query_plans [num_edits] [path]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sqlite3
+import sys
+from datetime import datetime
+from timeit import default_timer as timer
+
+from typing import Dict, List, Tuple
+
+from storytelling_db import StoryTellingDatabase, DB_SCHEMA
+
+NUM_USERS = 10000
+NUM_REPEATS = 200
+
+BEFORE = dict(
+    user_exists='SELECT id FROM users WHERE username = ?',
+    get_story='SELECT id FROM stories WHERE storyname = ?',
+    get_edited_stories='''
+        SELECT stories.id, storyname FROM edits, stories, users
+            WHERE user_id = users.id
+            AND story_id = stories.id
+            AND users.id = ?''',
+    get_last_edit='''
+        SELECT users.id, username, text, time FROM edits, users
+            WHERE edits.ROWID = (
+                SELECT max(edits.ROWID) FROM edits, users, stories
+                    WHERE user_id = users.id
+                        AND story_id = stories.id
+                        AND stories.id = ?
+            )''',
+)  # type: Dict[str, str]
+
+AFTER = dict(
+    user_exists=BEFORE['user_exists'],
+    get_story=BEFORE['get_story'],
+    get_edited_stories='''
+        SELECT stories.id, storyname FROM edits, stories
+            WHERE story_id = stories.id
+            AND user_id = ?''',
+    get_last_edit='''
+        SELECT users.id, username, text, time FROM edits, users
+            WHERE user_id = users.id
+                AND story_id = ?
+            ORDER BY edits.ROWID DESC
+            LIMIT 1''',
+)  # type: Dict[str, str]
+
+
+def populate(path, num_edits):
+    # type: (str, int) -> Tuple[int, int]
+    """Create an unmigrated DB with `num_edits` edits spread over stories of `NUM_USERS` edits."""
+    num_stories = max(1, num_edits // NUM_USERS)
+    conn = sqlite3.connect(path)
+    for table in ('users', 'stories', 'edits'):
+        conn.execute(DB_SCHEMA[table])
+    now = datetime.now().isoformat()
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?)',
+                     ((i, u'user{}'.format(i), u'', now) for i in xrange(1, NUM_USERS + 1)))
+    conn.executemany('INSERT INTO stories VALUES (?, ?, ?)',
+                     ((i, u'story{}'.format(i), now) for i in xrange(1, num_stories + 1)))
+    conn.executemany('INSERT INTO edits VALUES (?, ?, ?, ?)',
+                     ((i % num_stories + 1, i // num_stories + 1, u'line {}'.format(i), now)
+                      for i in xrange(num_edits)))
+    conn.commit()
+    conn.close()
+    return NUM_USERS, num_stories
+
+
+def args_for(name, num_users, num_stories):
+    # type: (str, int, int) -> List
+    if name == 'user_exists':
+        return [u'user{}'.format(random.randint(1, num_users))]
+    if name == 'get_story':
+        return [u'story{}'.format(random.randint(1, num_stories))]
+    if name == 'get_edited_stories':
+        return [random.randint(1, num_users)]
+    return [random.randint(1, num_stories)]
+
+
+def run(conn, queries, num_users, num_stories):
+    # type: (sqlite3.Connection, Dict[str, str], int, int) -> None
+    for name, sql in sorted(queries.viewitems()):
+        print('  {}:'.format(name))
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, args_for(name, num_users, num_stories)):
+            print('    ' + row[-1])
+        random.seed(0)
+        start = timer()
+        for _ in xrange(NUM_REPEATS):
+            conn.execute(sql, args_for(name, num_users, num_stories)).fetchall()
+        elapsed = (timer() - start) / NUM_REPEATS
+        print('    {:.3f} ms/query'.format(elapsed * 1000))
+
+
+def main():
+    num_edits = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = sys.argv[2] if len(sys.argv) > 2 else 'data/bench_query_plans.db'
+    if os.path.exists(path):
+        os.remove(path)
+    num_users, num_stories = populate(path, num_edits)
+    print('{} users, {} stories, {} edits'.format(num_users, num_stories, num_edits))
+
+    print('before migrations:')
+    conn = sqlite3.connect(path)
+    run(conn, BEFORE, num_users, num_stories)
+    conn.close()
+
+    db = StoryTellingDatabase(path)
+    with db.db.writing():
+        print('after migrations (schema version {}):'.format(db.schema_version))
+        run(db.db.conn, AFTER, num_users, num_stories)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Latency, throughput and queries per request of the app's routes,
+driven through the Flask test client against generated databases of several sizes.
+
+Each database is generated once by `generate_dataset` into `data/benchmarks/`
+and copied for every run, since the write routes modify it.
+Results are written as JSON.  Given a baseline (the results of an earlier run),
+the run fails if any route's p95 latency regressed by more than the tolerance
+and by at least the minimum delta (so timer noise on sub-millisecond routes isn't flagged),
+or its queries per request increased.
+
+Usage (from the repo root):
+    python -m benchmarks.routes [--sizes small,medium] [--requests 200]
+        [--output results.json] [--baseline baseline.json] [--tolerance 0.25]
+        [--min-delta-ms 0.5]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from timeit import default_timer as timer
+
+from typing import Any, Callable, Dict, Iterator, List
+
+# the benchmark swaps in its own databases, so don't open the app's
+os.environ.setdefault('STORYTELLING_DB', ':memory:')
+
+import app as storytelling_app
+from flask import Response
+from flask.testing import FlaskClient
+from generate_dataset import DatasetGenerator
+from story_builder import PrivilegedStoryTellingDatabase
+from story_fragments import StoryFragmentCache
+from storytelling_db import StoryTellingDatabase, User
+from util.db import DEFAULT_GROUP_COMMIT_INTERVAL
+from util.flask_json import use_named_tuple_json
+from util.template_context import add_template_context
+
+"""Numbers of users, stories and edits of each database size."""
+SIZES = OrderedDict([
+    ('small', (1000, 100, 10000)),
+    ('medium', (10000, 1000, 100000)),
+    ('large', (100000, 10000, 1000000)),
+])
+DATASET_DIR = 'data/benchmarks'
+DEFAULT_REQUESTS = 200
+DEFAULT_WARMUP = 10
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_MIN_DELTA_MS = 0.5
+
+Dataset = namedtuple('Dataset', ['name', 'num_users', 'storynames'])
+Request = Callable[[], Response]
+Scenario = Callable[[FlaskClient, Dataset], Iterator[Request]]
+
+
+def dataset_path(size):
+    # type: (str) -> str
+    return os.path.join(DATASET_DIR, 'routes-{}.db'.format(size))
+
+
+def ensure_dataset(size):
+    # type: (str) -> str
+    path = dataset_path(size)
+    if not os.path.exists(path):
+        if not os.path.isdir(DATASET_DIR):
+            os.makedirs(DATASET_DIR)
+        print('generating {} dataset'.format(size))
+        db = PrivilegedStoryTellingDatabase(path)
+        DatasetGenerator(db).generate(*SIZES[size])
+        db.close()
+    return path
+
+
+def login(client, username):
+    # type: (FlaskClient, unicode) -> Response
+    """Log in a generated user, whose password is its username."""
+    return client.post('/auth', data=dict(username=username, password=username))
+
+
+def signup(client, username):
+    # type: (FlaskClient, unicode) -> Response
+    return client.post('/signup', data=dict(username=username, password=username))
+
+
+def bench_auth(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    for i in xrange(sys.maxint):
+        username = u'user{}'.format(i % dataset.num_users + 1)
+        yield lambda: login(client, username)
+
+
+def bench_signup(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    for i in xrange(sys.maxint):
+        username = u'bench_user{}'.format(i)
+        yield lambda: signup(client, username)
+
+
+def bench_home(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    login(client, u'user1')
+    while True:
+        yield lambda: client.get('/home')
+
+
+def _bench_story(client, edited):
+    # type: (FlaskClient, bool) -> Iterator[Request]
+    login(client, u'user1')
+    db = storytelling_app.db
+    user = User(1, u'user1')
+    with db:
+        if edited:
+            stories = list(db.get_edited_stories(user))
+        else:
+            stories = list(db.get_unedited_stories(user, 0, DEFAULT_REQUESTS))
+    if not stories:
+        return
+    for i in xrange(sys.maxint):
+        storyname = stories[i % len(stories)].storyname
+        yield lambda: client.post('/story', data=dict(story=storyname))
+
+
+def bench_story_read(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    """/story for Stories the User has edited, which streams the whole Story."""
+    return _bench_story(client, True)
+
+
+def bench_story_edit(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    """/story for Stories the User hasn't edited, which shows the last Edit."""
+    return _bench_story(client, False)
+
+
+def bench_edit(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    """A new User editing each Story once, opening it with /story first (not measured)."""
+    signup(client, u'bench_editor')
+    for storyname in dataset.storynames:
+        client.post('/story', data=dict(story=storyname))
+        yield lambda: client.post('/edit', data=dict(text=u'Benchmark edit.'))
+
+
+def bench_new_story(client, dataset):
+    # type: (FlaskClient, Dataset) -> Iterator[Request]
+    login(client, u'user1')
+    for i in xrange(sys.maxint):
+        data = dict(storyname=u'Benchmark story {}'.format(i), text=u'Benchmark start.')
+        yield lambda: client.post('/new_story', data=data)
+
+
+SCENARIOS = OrderedDict([
+    ('/auth', bench_auth),
+    ('/signup', bench_signup),
+    ('/home', bench_home),
+    ('/story (read)', bench_story_read),
+    ('/story (edit)', bench_story_edit),
+    ('/edit', bench_edit),
+    ('/new_story', bench_new_story),
+])  # type: Dict[str, Scenario]
+
+
+def percentile(sorted_values, p):
+    # type: (List[float], float) -> float
+    """Nearest-rank percentile."""
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def summarize(latencies, queries):
+    # type: (List[float], List[int]) -> Dict[str, float]
+    latencies = sorted(latencies)
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('p50_ms', percentile(latencies, 50) * 1000),
+        ('p95_ms', percentile(latencies, 95) * 1000),
+        ('p99_ms', percentile(latencies, 99) * 1000),
+        ('throughput', len(latencies) / sum(latencies)),
+        ('queries_per_request', float(sum(queries)) / len(queries)),
+    ])
+
+
+def run_scenario(scenario, dataset, num_requests, warmup):
+    # type: (Scenario, Dataset, int, int) -> Dict[str, float] | None
+    client = storytelling_app.app.test_client()
+    db = storytelling_app.db.db
+    latencies = []  # type: List[float]
+    queries = []  # type: List[int]
+    for i, request in enumerate(islice(scenario(client, dataset), warmup + num_requests)):
+        num_queries = db.num_queries
+        start = timer()
+        response = request()
+        response.get_data()  # consume streamed responses
+        elapsed = timer() - start
+        if response.status_code >= 400:
+            raise RuntimeError('{} {}'.format(response.status, response.get_data()))
+        if i >= warmup:
+            latencies.append(elapsed)
+            queries.append(db.num_queries - num_queries)
+    if not latencies:
+        return None
+    return summarize(latencies, queries)
+
+
+def run_size(size, num_requests, warmup):
+    # type: (str, int, int) -> Dict[str, Dict[str, float]]
+    num_users = SIZES[size][0]
+    source = ensure_dataset(size)
+    tmp_dir = tempfile.mkdtemp()
+    results = OrderedDict()
+    try:
+        for i, (name, scenario) in enumerate(SCENARIOS.viewitems()):
+            # a fresh copy for each route, so writes of one don't affect the next,
+            # at a new path, so no stale -wal file of the previous copy is picked up
+            storytelling_app.db.close()
+            path = os.path.join(tmp_dir, 'routes-{}.db'.format(i))
+            shutil.copy(source, path)
+            db = StoryTellingDatabase(path, group_commit_interval=DEFAULT_GROUP_COMMIT_INTERVAL)
+            storytelling_app.db = db
+            storytelling_app.fragment_cache = StoryFragmentCache(db, storytelling_app.app.jinja_env)
+            db.caches.append(storytelling_app.fragment_cache)
+            with db:
+                storynames = [storyname for storyname, in db.db.cursor.execute(
+                    'SELECT storyname FROM stories ORDER BY id')]
+            result = run_scenario(scenario, Dataset(size, num_users, storynames),
+                                  num_requests, warmup)
+            if result is not None:
+                results[name] = result
+                print('{:>7} {:<14} p50 {p50_ms:7.2f} ms  p95 {p95_ms:7.2f} ms  '
+                      'p99 {p99_ms:7.2f} ms  {throughput:7.1f} req/s  '
+                      '{queries_per_request:5.1f} queries/req'.format(size, name, **result))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    # type: (Dict[str, Dict[str, Dict[str, float]]], Dict[str, Dict[str, Dict[str, float]]], float, float) -> List[str]
+    """
+    Regressions of results from the baseline, for sizes and routes in both.
+    A p95 latency regresses if it's over the baseline's by both `tolerance` and `min_delta_ms`.
+    """
+    regressions = []
+    for size, routes in results.viewitems():
+        for name, result in routes.viewitems():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            if result['p95_ms'] > base['p95_ms'] * (1 + tolerance) \
+                    and result['p95_ms'] - base['p95_ms'] >= min_delta_ms:
+                regressions.append('{} {}: p95 {:.2f} ms > baseline {:.2f} ms'.format(
+                    size, name, result['p95_ms'], base['p95_ms']))
+            if result['queries_per_request'] > base['queries_per_request']:
+                regressions.append('{} {}: {:.1f} queries/request > baseline {:.1f}'.format(
+                    size, name, result['queries_per_request'], base['queries_per_request']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='small,medium',
+                        help='comma-separated sizes of {}'.format(', '.join(SIZES)))
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP,
+                        help='unmeasured requests per route first')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed relative p95 latency increase over the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS,
+                        help='smallest p95 latency increase in ms counted as a regression')
+    args = parser.parse_args()
+    sizes = args.sizes.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            parser.error('unknown size: {}'.format(size))
+
+    flask_app = storytelling_app.app
+    flask_app.secret_key = 'benchmark'
+    flask_app.testing = True  # raise errors in routes instead of returning 500s
+    add_template_context(flask_app)
+    use_named_tuple_json(flask_app)
+
+    results = OrderedDict(
+        (size, run_size(size, args.requests, args.warmup)) for size in sizes
+    )  # type: Dict[str, Dict[str, Dict[str, Any]]]
+    storytelling_app.db.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('no regressions from {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
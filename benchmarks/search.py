@@ -0,0 +1,119 @@
+"""
+Latency of `StoryTellingDatabase.search` on a large synthetic corpus.
+
+Fills a fresh database with `num_lines` edits of Zipf-distributed words
+with the search triggers suspended, times the index rebuild,
+then times searches for common, rare and multi-word queries and storynames.
+
+Usage (from the repo root):
+    python -m benchmarks.search [num_lines] [path]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+from bisect import bisect
+from datetime import datetime
+from timeit import default_timer as timer
+
+from typing import List
+
+from storytelling_db import encode_time
+from story_builder import PrivilegedStoryTellingDatabase
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_LINE = 10
+LINES_PER_STORY = 5000
+NUM_REPEATS = 20
+CHUNK_SIZE = 100000
+
+
+def make_vocabulary(rand):
+    # type: (random.Random) -> List[unicode]
+    letters = u'abcdefghijklmnopqrstuvwxyz'
+    return [u''.join(rand.choice(letters) for _ in xrange(rand.randint(3, 9)))
+            for _ in xrange(VOCABULARY_SIZE)]
+
+
+def zipf_cumulative_weights(n):
+    # type: (int) -> List[float]
+    total = 0.0
+    weights = []
+    for rank in xrange(1, n + 1):
+        total += 1.0 / rank
+        weights.append(total)
+    return weights
+
+
+def populate(db, num_lines, rand, vocabulary):
+    # type: (PrivilegedStoryTellingDatabase, int, random.Random, List[unicode]) -> None
+    weights = zipf_cumulative_weights(len(vocabulary))
+    total = weights[-1]
+
+    def line():
+        return u' '.join(vocabulary[bisect(weights, rand.random() * total)]
+                         for _ in xrange(WORDS_PER_LINE))
+
+    cursor = db.db.cursor
+    num_users = min(num_lines, LINES_PER_STORY)
+    cursor.executemany(
+        "INSERT INTO users (id, username, password, start_time, start_time_us) "
+        "VALUES (?, ?, '', '', 0)",
+        ((i, u'user{}'.format(i)) for i in xrange(1, num_users + 1)))
+    num_stories = (num_lines + LINES_PER_STORY - 1) // LINES_PER_STORY
+    cursor.executemany(
+        "INSERT INTO stories (id, storyname, start_time, start_time_us) VALUES (?, ?, '', 0)",
+        ((i, u'{} {}'.format(vocabulary[i % 1000], i)) for i in xrange(1, num_stories + 1)))
+    time = encode_time(datetime.now())
+    for start in xrange(0, num_lines, CHUNK_SIZE):
+        cursor.executemany(
+            "INSERT INTO edits (story_id, user_id, text, time, time_us) VALUES (?, ?, ?, '', ?)",
+            ((i // LINES_PER_STORY + 1, i % LINES_PER_STORY + 1, line(), time)
+             for i in xrange(start, min(start + CHUNK_SIZE, num_lines))))
+        db.commit()
+        print('  {} lines'.format(min(start + CHUNK_SIZE, num_lines)))
+
+
+def time_query(db, query):
+    # type: (PrivilegedStoryTellingDatabase, unicode) -> None
+    start = timer()
+    for _ in xrange(NUM_REPEATS):
+        with db:
+            results = db.search(query)
+    elapsed = (timer() - start) / NUM_REPEATS
+    print(u'  {:<30} {:8.2f} ms  ({} results)'.format(query, elapsed * 1000, len(results)))
+
+
+def main():
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    path = sys.argv[2] if len(sys.argv) > 2 else 'data/bench_search.db'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rand = random.Random(0)
+    vocabulary = make_vocabulary(rand)
+    db = PrivilegedStoryTellingDatabase(path)
+
+    print('inserting {} lines with the search index suspended:'.format(num_lines))
+    start = timer()
+    with db.search_index_suspended():
+        populate(db, num_lines, rand, vocabulary)
+        inserted = timer()
+    print('inserted in {:.1f} s, index rebuilt in {:.1f} s'.format(
+        inserted - start, timer() - inserted))
+
+    print('search latency (mean of {}):'.format(NUM_REPEATS))
+    for query in (vocabulary[0],  # most common word
+                  vocabulary[100],
+                  vocabulary[-1],  # rarest word
+                  u'{} {}'.format(vocabulary[1], vocabulary[2]),
+                  u'{} {}'.format(vocabulary[50], vocabulary[5000]),
+                  u'{} 7'.format(vocabulary[7])):  # a storyname
+        time_query(db, query)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
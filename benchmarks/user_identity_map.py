@@ -0,0 +1,119 @@
+"""
+Memory and time of reading the Edits of a long story with and without the `IdentityMap`.
+
+Reads the Edits of a story with `num_edits` edits (each by a different User,
+since a User edits a Story at most once) and sums `sys.getsizeof`
+of every distinct object they reference: Edits, Users, usernames, texts and times.
+With the identity map, a second read, like another request for the story
+or for another story by the same Users, only allocates what isn't in the map:
+the Edits of another story by the same Users share their Users,
+and a re-read of the same story shares its Edits.
+
+Usage (from the repo root):
+    python -m benchmarks.user_identity_map [num_edits] [path]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from timeit import default_timer as timer
+
+from typing import Iterable, List, Set, Tuple
+
+from storytelling_db import Edit, StoryTellingDatabase
+from story_builder import PrivilegedStoryTellingDatabase
+
+NUM_EDITS = 10000
+
+
+def remove_db(path):
+    # type: (str) -> None
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def populate(path, num_edits):
+    # type: (str, int) -> None
+    db = PrivilegedStoryTellingDatabase(path)
+    _ = db.users
+    for i in xrange(num_edits):
+        db.add_user(u'user{}'.format(i), u'')
+    db.commit()
+    for storyname in (u'First', u'Second'):
+        story, _ = db.add_story(storyname, db.users[1], u'Once upon a time.')
+        db.add_edits(story, 2, (u'Edit number {} of {}.'.format(i, storyname)
+                                for i in xrange(num_edits - 1)))
+        db.commit()
+    db.close()
+
+
+def deep_size(objs, exclude=frozenset()):
+    # type: (Iterable[object], Set[int]) -> int
+    """Total size of the distinct objects reachable through tuples, excluding ids in `exclude`."""
+    seen = set(exclude)
+    total = 0
+    stack = list(objs)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, tuple):
+            stack.extend(obj)
+    return total
+
+
+def read_edits(db, storyname):
+    # type: (StoryTellingDatabase, unicode) -> Tuple[List[Edit], float]
+    """The Edits of a story, and the seconds it took to read them."""
+    start = timer()
+    with db:
+        edits = list(db.get_edits(db.get_story(storyname)))
+    return edits, timer() - start
+
+
+def in_map(db):
+    # type: (StoryTellingDatabase) -> List[object]
+    """The Users, Stories and Edits in the identity map."""
+    return [value for cache in db.identity_map.caches for value, _ in cache._entries.viewvalues()]
+
+
+def main():
+    num_edits = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_EDITS
+    path = sys.argv[2] if len(sys.argv) > 2 else 'data/benchmark_user_identity_map.db'
+    remove_db(path)
+    populate(path, num_edits)
+
+    db = StoryTellingDatabase(path, identity_map_size=0)
+    edits, elapsed = read_edits(db, u'First')
+    again, again_elapsed = read_edits(db, u'First')
+    print('{} edits without identity map: {:.2f} MB per read, {:.1f} ms first read, {:.1f} ms again'
+          .format(len(edits), deep_size(edits) / 1e6, elapsed * 1000, again_elapsed * 1000))
+    db.close()
+
+    db = StoryTellingDatabase(path)
+    first, elapsed = read_edits(db, u'First')
+    map_ids = {id(obj) for obj in in_map(db)}
+    second, _ = read_edits(db, u'Second')
+    again, again_elapsed = read_edits(db, u'First')
+    print('{} edits with identity map:    {:.2f} MB first read, {:.1f} ms'.format(
+        len(first), deep_size(first) / 1e6, elapsed * 1000))
+    print('    second story by the same Users: {:.2f} MB per read'.format(
+        deep_size(second, map_ids) / 1e6))
+    map_ids = {id(obj) for obj in in_map(db)}
+    print('    same story again:               {:.2f} MB per read, {:.1f} ms'.format(
+        deep_size(again, map_ids) / 1e6, again_elapsed * 1000))
+    print('    the map holds {:.2f} MB'.format(deep_size(in_map(db)) / 1e6))
+    print('    distinct Users across the reads: {} (vs {} without the map)'.format(
+        len({id(edit.user) for edit in first + second + again}), 3 * num_edits))
+    print('    distinct Edits across the reads: {} (vs {} without the map)'.format(
+        len({id(edit) for edit in first + second + again}), 3 * num_edits))
+    db.close()
+    remove_db(path)
+
+
+if __name__ == '__main__':
+    main()
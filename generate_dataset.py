@@ -0,0 +1,243 @@
+"""
+Generate a deterministic synthetic database of users, stories and edits
+for load and scaling tests, using `PrivilegedStoryTellingDatabase`.
+
+Story popularity (edits per story) follows a Zipf distribution,
+edit lengths (in words) follow a configurable histogram,
+and edits of different stories are interleaved in time.
+The same arguments and seed always generate the same users, stories and edits.
+
+Usage:
+    python generate_dataset.py --users 100000 --stories 20000 --edits 10000000 data/large.db
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from fractions import gcd
+from itertools import islice
+from timeit import default_timer as timer
+
+from typing import Iterable, List, Tuple
+
+from storytelling_db import encode_time
+from story_builder import PrivilegedStoryTellingDatabase
+
+DEFAULT_EDIT_LENGTHS = '1:0.05,5:0.25,12:0.40,30:0.20,80:0.10'
+DEFAULT_VOCABULARY_SIZE = 20000
+TEXT_POOL_SIZE = 1 << 16
+"""Number of distinct edit texts; edits draw from them so each costs one random draw."""
+CHUNK_SIZE = 100000
+"""Number of edits inserted per transaction."""
+START_TIME = datetime(2017, 10, 1)
+EDIT_INTERVAL = timedelta(milliseconds=250)
+"""Generated stories and edits are timestamped every EDIT_INTERVAL from START_TIME."""
+
+EditRow = Tuple[int, int, unicode, str, int]
+
+
+def parse_histogram(spec):
+    # type: (str) -> List[Tuple[int, float]]
+    """Parse 'bound:weight,...', where edit lengths are uniform in (previous bound, bound]."""
+    buckets = []
+    for bucket in spec.split(','):
+        bound, weight = bucket.split(':')
+        buckets.append((int(bound), float(weight)))
+    return sorted(buckets)
+
+
+def cumulative(weights):
+    # type: (Iterable[float]) -> List[float]
+    total = 0.0
+    sums = []
+    for weight in weights:
+        total += weight
+        sums.append(total)
+    return sums
+
+
+class _StoryEdits(object):
+    """Distinct editors of a story: (offset + k * step) mod num_users + 1 for k < num_edits."""
+
+    def __init__(self, story_id, num_edits, offset, step):
+        # type: (int, int, int, int) -> None
+        self.story_id = story_id
+        self.num_edits = num_edits
+        self.offset = offset
+        self.step = step
+        self.k = 0
+
+
+class DatasetGenerator(object):
+    def __init__(self, db, seed=0, zipf_exponent=1.0, edit_lengths=DEFAULT_EDIT_LENGTHS,
+                 vocabulary_size=DEFAULT_VOCABULARY_SIZE):
+        # type: (PrivilegedStoryTellingDatabase, int, float, str, int) -> None
+        self._db = db
+        self._rand = random.Random(seed)
+        self.zipf_exponent = zipf_exponent
+        self.edit_lengths = parse_histogram(edit_lengths)
+        self.vocabulary_size = vocabulary_size
+
+    def _vocabulary(self):
+        # type: () -> List[unicode]
+        letters = u'abcdefghijklmnopqrstuvwxyz'
+        rand = self._rand
+        return [u''.join(rand.choice(letters) for _ in xrange(rand.randint(2, 10)))
+                for _ in xrange(self.vocabulary_size)]
+
+    def _text_pool(self):
+        # type: () -> List[unicode]
+        """Pre-generate the texts edits are drawn from, so each edit costs one random draw."""
+        rand = self._rand
+        vocabulary = self._vocabulary()
+        word_weights = cumulative(1.0 / rank for rank in xrange(1, len(vocabulary) + 1))
+        length_weights = cumulative(weight for _, weight in self.edit_lengths)
+        bounds = [0] + [bound for bound, _ in self.edit_lengths]
+        texts = []
+        for _ in xrange(TEXT_POOL_SIZE):
+            bucket = bisect(length_weights, rand.random() * length_weights[-1])
+            length = rand.randint(bounds[bucket] + 1, bounds[bucket + 1])
+            texts.append(u' '.join(
+                vocabulary[bisect(word_weights, rand.random() * word_weights[-1])]
+                for _ in xrange(length)).capitalize() + u'.')
+        return texts
+
+    def _edits_per_story(self, num_users, num_stories, num_edits):
+        # type: (int, int, int) -> List[int]
+        """Zipf-distributed edit counts, each at least 1 and at most num_users."""
+        ranks = range(1, num_stories + 1)
+        self._rand.shuffle(ranks)
+        weights = [rank ** -self.zipf_exponent for rank in ranks]
+        total = sum(weights)
+        counts = [min(num_users, max(1, int(num_edits * weight / total))) for weight in weights]
+        # hand out what rounding and capping left over to stories with room, most popular first
+        remaining = num_edits - sum(counts)
+        by_popularity = sorted(xrange(num_stories), key=lambda i: ranks[i])
+        while remaining > 0:
+            progress = False
+            for i in by_popularity:
+                if counts[i] < num_users:
+                    extra = min(remaining, num_users - counts[i], max(1, remaining // num_stories))
+                    counts[i] += extra
+                    remaining -= extra
+                    progress = True
+                    if remaining == 0:
+                        break
+            if not progress:
+                print('only {} edits fit ({} per story at most)'.format(
+                    num_edits - remaining, num_users))
+                break
+        return counts
+
+    def _add_users(self, num_users):
+        # type: (int) -> None
+        db = self._db
+        _ = db.users
+        for i in xrange(db.num_users + 1, num_users + 1):
+            username = u'user{}'.format(i)
+            db.add_user(username, username)  # passwords are the usernames
+        db.commit()
+
+    def _add_stories(self, num_stories):
+        # type: (int) -> None
+        vocabulary = self._vocabulary()
+        rand = self._rand
+
+        def rows():
+            for story_id in xrange(1, num_stories + 1):
+                time = START_TIME + story_id * EDIT_INTERVAL
+                storyname = u'{} {} {}'.format(rand.choice(vocabulary).capitalize(),
+                                               rand.choice(vocabulary), story_id)
+                yield story_id, storyname, time.isoformat(), encode_time(time)
+
+        self._db.db.cursor.executemany(
+            'INSERT INTO stories (id, storyname, start_time, start_time_us) VALUES (?, ?, ?, ?)',
+            rows())
+        self._db.commit()
+
+    def _edit_rows(self, num_users, counts, texts):
+        # type: (int, List[int], List[unicode]) -> Iterable[EditRow]
+        """Yield edits of all stories round-robin, so popular stories keep getting edits."""
+        rand = self._rand
+        active = []  # type: List[_StoryEdits]
+        for story_id, count in enumerate(counts, 1):
+            step = rand.randint(1, num_users)
+            while gcd(step, num_users) != 1:
+                step = rand.randint(1, num_users)
+            active.append(_StoryEdits(story_id, count, rand.randrange(num_users), step))
+        i = 0
+        num_texts = len(texts)
+        while active:
+            still_active = []
+            for story in active:
+                user_id = (story.offset + story.k * story.step) % num_users + 1
+                time = START_TIME + i * EDIT_INTERVAL
+                yield (story.story_id, user_id, texts[rand.randrange(num_texts)],
+                       time.isoformat(), encode_time(time))
+                i += 1
+                story.k += 1
+                if story.k < story.num_edits:
+                    still_active.append(story)
+            active = still_active
+
+    def generate(self, num_users, num_stories, num_edits):
+        # type: (int, int, int) -> None
+        db = self._db
+        start = timer()
+        print('adding {} users'.format(num_users))
+        self._add_users(num_users)
+        print('adding {} stories'.format(num_stories))
+        self._add_stories(num_stories)
+        counts = self._edits_per_story(num_users, num_stories, num_edits)
+        texts = self._text_pool()
+        print('adding {} edits'.format(sum(counts)))
+        rows = self._edit_rows(num_users, counts, texts)
+        num_added = 0
+        with db.search_index_suspended():
+            while True:
+                chunk = list(islice(rows, CHUNK_SIZE))
+                if not chunk:
+                    break
+                db.db.cursor.executemany(
+                    'INSERT INTO edits (story_id, user_id, text, time, time_us) '
+                    'VALUES (?, ?, ?, ?, ?)', chunk)
+                db.commit()
+                num_added += len(chunk)
+                print('  {} edits, {:.0f} s'.format(num_added, timer() - start))
+            print('rebuilding search index')
+        print('generated in {:.0f} s'.format(timer() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='database to create (must not exist)')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--stories', type=int, default=1000)
+    parser.add_argument('--edits', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--zipf-exponent', type=float, default=1.0,
+                        help='skew of edits per story')
+    parser.add_argument('--edit-lengths', default=DEFAULT_EDIT_LENGTHS,
+                        help='histogram of words per edit as bound:weight,...; '
+                             'lengths are uniform in (previous bound, bound]')
+    parser.add_argument('--vocabulary-size', type=int, default=DEFAULT_VOCABULARY_SIZE)
+    parser.add_argument('--hash-workers', type=int, default=multiprocessing.cpu_count(),
+                        help='processes hashing user passwords (default: one per CPU)')
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error('{} already exists'.format(args.path))
+    db = PrivilegedStoryTellingDatabase(args.path, hash_workers=args.hash_workers)
+    db.db.cursor.execute('PRAGMA synchronous = OFF')  # a crash just means regenerating
+    DatasetGenerator(db, args.seed, args.zipf_exponent, args.edit_lengths,
+                     args.vocabulary_size).generate(args.users, args.stories, args.edits)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
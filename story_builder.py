@@ -1,15 +1,20 @@
 from __future__ import print_function
 
 import io
+import multiprocessing
 import os
+from contextlib import contextmanager
 from datetime import datetime
-from itertools import permutations
+from itertools import imap, islice, izip, permutations
+from multiprocessing.pool import AsyncResult
+from Queue import Empty
 from sys import stderr
+from timeit import default_timer as timer
 
-from typing import Dict, Union, Iterable, Iterator, List, Tuple, IO, Set
+from typing import Any, Dict, Union, Iterable, Iterator, List, Tuple, IO, Set
 
 from storytelling_db import StoryTellingDatabase, User, Story, Edit, StoryTellingException, \
-    hash_password
+    hash_password, encode_time, SEARCH_TRIGGERS
 
 
 def utf8(s):
@@ -17,9 +22,26 @@ def utf8(s):
     return unicode(s, encoding='utf-8', errors='replace')
 
 
+"""Number of passwords sent to a hashing process at once."""
+HASH_CHUNK_SIZE = 256
+
+
 class PrivilegedStoryTellingDatabase(StoryTellingDatabase):
-    def __init__(self, path='data/storytelling.db'):
+    """
+    Single-threaded bulk writer, using the writer connection directly,
+    so it holds the DB's write lock from when it's opened until it's closed.
+    """
+
+    def __init__(self, path='data/storytelling.db', hash_workers=1):
+        # type: (str, int) -> None
+        """
+        :param hash_workers: number of processes hashing the passwords of added users
+            (default: 1, hashes them in this process without a pool)
+        """
         super(PrivilegedStoryTellingDatabase, self).__init__(path)
+        self.db.lock_writes()
+        self.hash_workers = hash_workers  # type: int
+        self._hash_pool = None  # type: multiprocessing.Pool
         self._num_users = -1  # type: int
         self._last_committed_uid = 0  # type: int
         self._usernames = None  # type: Set[unicode]
@@ -91,59 +113,152 @@ class PrivilegedStoryTellingDatabase(StoryTellingDatabase):
     def add_user(self, username, password):
         if username in self.usernames:
             raise StoryTellingException('username already in use')
-        uid = self._num_users + 1
+        users = self.users
+        uid = self.num_users + 1
         self._num_users = uid
         self._usernames.add(username)
-        self._users[uid] = User(uid, username)
+        users[uid] = User(uid, username)
+
+    def _hash_passwords(self, passwords):
+        # type: (List[unicode]) -> Iterator[unicode]
+        """
+        Hash passwords in order.  With more than one hash worker,
+        they're hashed in chunks by a process pool while the hashes are consumed.
+        """
+        if self.hash_workers == 1:
+            return imap(hash_password, passwords)
+        if self._hash_pool is None:
+            self._hash_pool = multiprocessing.Pool(self.hash_workers)
+        return self._hash_pool.imap(hash_password, passwords, HASH_CHUNK_SIZE)
 
     def _yield_new_users(self):
-        # type: () -> Iterable[Tuple[int, unicode, unicode, str]]
+        # type: () -> Iterable[Tuple[int, unicode, unicode, str, int]]
         start = self._last_committed_uid + 1
         end = self._num_users
-        for uid in xrange(start, end + 1):
-            if uid % 100 == 0:
+        uids = xrange(start, end + 1)
+        usernames = [self._users[uid].username for uid in uids]
+        for uid, username, hashed_password in izip(uids, usernames,
+                                                   self._hash_passwords(usernames)):
+            if uid % 1000 == 0:
                 print('adding user #{} out of {}'.format(uid, end))
-            username = self._users[uid].username
-            yield uid, username, hash_password(username), datetime.now().isoformat()
+            time = datetime.now()
+            yield uid, username, hashed_password, time.isoformat(), encode_time(time)
 
     def commit_added_users(self):
+        # type: () -> None
+        """Insert the users added since the last commit, and commit."""
+        self.commit()
+
+    def _insert_added_users(self):
+        # type: () -> None
+        """Insert the users added since the last commit, without committing them."""
         if self._last_committed_uid == self._num_users:
             return
-        self.db.cursor.executemany('INSERT INTO users VALUES (?, ?, ?, ?)', self._yield_new_users())
-        self._last_committed_uid = self._num_users
+        self.db.cursor.executemany(
+            'INSERT INTO users (id, username, password, start_time, start_time_us) '
+            'VALUES (?, ?, ?, ?, ?)',
+            self._yield_new_users())
 
     def add_story(self, storyname, user, text):
         # type: (unicode, User, unicode) -> Tuple[Story, Edit]
         story, edit = super(PrivilegedStoryTellingDatabase, self).add_story(storyname, user, text)
-        self.stories[story.id] = story
-        self.edits[story.id] = {user.id: edit}
+        self.cache_added_story(story, edit)
         return story, edit
 
+    def cache_added_story(self, story, edit):
+        # type: (Story, Edit) -> None
+        # only update the caches if loaded, loading edits reads every edit
+        if self._stories is not None:
+            self._stories[story.id] = story
+        if self._edits is not None:
+            self._edits[story.id] = {edit.user.id: edit}
+
+    def add_edits(self, story, first_uid, texts):
+        # type: (Story, int, Iterable[unicode]) -> None
+        """
+        Insert Edits of the given texts by consecutive users starting at uid `first_uid`,
+        without committing or caching them.
+        """
+        time = datetime.now()
+        iso_time = time.isoformat()
+        time_us = encode_time(time)
+        self.db.cursor.executemany(
+            'INSERT INTO edits (story_id, user_id, text, time, time_us) VALUES (?, ?, ?, ?, ?)',
+            ((story.id, uid, text, iso_time, time_us) for uid, text in enumerate(texts, first_uid)))
+
     def _yield_edit_values(self, story, uids, texts):
-        # type: (Story, Iterator[int], Iterator[unicode]) -> Iterable[Tuple[int, int, unicode, str]]
+        # type: (Story, Iterator[int], Iterator[unicode]) -> Iterable[Tuple[int, int, unicode, str, int]]
         story_id = story.id
         edits = self.edits[story_id]
         for text in texts:
             uid = uids.next()
             time = datetime.now()
             edits[uid] = Edit(story, User(uid, None), text, time)
-            yield story_id, uids.next(), text, time.isoformat()
+            yield story_id, uids.next(), text, time.isoformat(), encode_time(time)
 
     def edit_story_many_times(self, story, uids, texts):
         # type: (Story, Iterator[int], Iterator[unicode]) -> None
-        self.db.conn.cursor().executemany('INSERT INTO edits VALUES (?, ?, ?, ?)',
-                                          self._yield_edit_values(story, uids, texts))
+        self.db.conn.cursor().executemany(
+            'INSERT INTO edits (story_id, user_id, text, time, time_us) VALUES (?, ?, ?, ?, ?)',
+            self._yield_edit_values(story, uids, texts))
         self.commit()
 
     def commit(self):
-        self.commit_added_users()
+        num_users = self._num_users
+        self._insert_added_users()
         super(PrivilegedStoryTellingDatabase, self).commit()
+        # only now, since a rolled back transaction discards the inserted users
+        self._last_committed_uid = num_users
+        self.clear_caches()  # bulk writes don't invalidate the entries they change
+
+    def close(self):
+        # type: () -> None
+        # commit the added users first, since hashing their passwords can start the hash pool
+        self.commit()
+        super(PrivilegedStoryTellingDatabase, self).close()
+        self.db.release_write_lock()
+
+    def hard_close(self):
+        # type: () -> None
+        super(PrivilegedStoryTellingDatabase, self).hard_close()
+        self.db.release_write_lock()
+
+    def _stop_workers(self):
+        # type: () -> None
+        if self._hash_pool is not None:
+            self._hash_pool.close()
+            self._hash_pool.join()
+            self._hash_pool = None
+        super(PrivilegedStoryTellingDatabase, self)._stop_workers()
+
+    @contextmanager
+    def search_index_suspended(self):
+        """
+        Drop the triggers updating the search index for a bulk import,
+        then recreate them and rebuild the whole index at once.
+        If the process dies first, the next StoryTellingDatabase opened does it instead.
+        """
+        if not self.db.table_exists('edits_search'):
+            yield
+            return
+        for trigger in SEARCH_TRIGGERS:
+            self.db.cursor.execute('DROP TRIGGER IF EXISTS {}'.format(trigger))
+        try:
+            yield
+        finally:
+            self.commit()
+            map(self.db.cursor.execute, SEARCH_TRIGGERS.viewvalues())
+            self.rebuild_search_index()
 
 
 class BadGutenbergStoryHeaderException(Exception):
     pass
 
 
+class IngestStalledException(Exception):
+    pass
+
+
 Number = Union[int, float]
 
 
@@ -160,6 +275,23 @@ def list_dir_txts(dir_path, max_files=float('inf')):
             break
 
 
+DEFAULT_INGEST_QUEUE_SIZE = 64  # chunks
+DEFAULT_INGEST_REPORT_INTERVAL = 5.0  # seconds
+INGEST_CHUNK_SIZE = 2000  # lines
+INGEST_POLL_INTERVAL = 1.0  # seconds
+DEFAULT_INGEST_STALL_TIMEOUT = 300.0  # seconds
+
+"""Progress of each file ingested by `StoryBuilder.add_gutenberg_stories`, so it can resume."""
+GUTENBERG_IMPORTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS gutenberg_imports(
+        filename TEXT PRIMARY KEY,
+        story_id INTEGER NOT NULL,
+        num_lines INTEGER NOT NULL,
+        done INTEGER NOT NULL,
+        FOREIGN KEY (story_id) REFERENCES stories(id)
+    )'''
+
+
 class StoryBuilder(object):
     DEFAULT_AUTHORS_PATH = 'data/authors.txt'
 
@@ -219,15 +351,17 @@ class StoryBuilder(object):
                 f.write(author)
                 f.write(u'\n')
 
-    def __init__(self, db, authors_filename=DEFAULT_AUTHORS_PATH, tmp_dir='data'):
-        # type: (PrivilegedStoryTellingDatabase, str, str) -> None
+    def __init__(self, db, authors_filename=DEFAULT_AUTHORS_PATH):
+        # type: (PrivilegedStoryTellingDatabase, str) -> None
         self._db = db  # type: PrivilegedStoryTellingDatabase
         self._authors_filename = authors_filename  # type: str
-        self.tmp_dir = tmp_dir  # type: str
+        self._db.db.cursor.execute(GUTENBERG_IMPORTS_SCHEMA)
         self._new_usernames = self._generate_usernames()  # type: Iterator[unicode]
         self._new_uids = self._generate_uids()  # type: Iterator[int]
         _ = self._db.users
+        _ = self._db.num_users
         self.num_stories_added = 0  # type: int
+        self.ingest_stats = None  # type: IngestStats
 
     def _generate_usernames(self):
         # type: () -> Iterable[unicode]
@@ -256,61 +390,257 @@ class StoryBuilder(object):
         story, edit = self._db.add_story(title, User(author, ''), 'Title: ' + title)
         self._db.edit_story_many_times(story, xrange(1, self._db.num_users + 1).__iter__(), lines)
 
-    def _buffer_story(self, story_filename):
-        # type: (str) -> Tuple[str, int, unicode, unicode]
-        with open(story_filename) as f:
-            title, author = self.find_author_title(f)
-
-            while f.readline()[:3] != '***':
-                pass
-
-            tmp = self.tmp_dir + '/' + os.path.basename(story_filename)
-            num_lines = 0
+    def _ensure_users(self, num_users):
+        # type: (int) -> None
+        """Add users until there are at least `num_users`, inserted by the next commit."""
+        if self._db.num_users >= num_users:
+            return
+        add_user = self._db.add_user
+        new_usernames = self._new_usernames
+        while self._db.num_users < num_users:
             try:
-                with io.open(tmp, 'w', encoding='utf-8') as buf:
-                    for line in f:
-                        line = line.strip()
-                        if len(line) == 0:
-                            continue
-                        buf.write(utf8(line))
-                        buf.write(u'\n')
-                        num_lines += 1
-            except:
-                os.remove(tmp)
-            return tmp, num_lines, title, author
-
-    def add_gutenberg_story(self, story_filename):
-        self.num_stories_added += 1
-        tmp, num_lines, title, author = self._buffer_story(story_filename)
-        try:
-            print(u'adding story #{} {} by {} ({})'.format(self.num_stories_added, title, author,
-                                                           utf8(story_filename)))
-            num_new_uids = num_lines - self._db.num_users
-            add_user = self._db.add_user
-            new_usernames = self._new_usernames
-            for i in xrange(num_new_uids):
                 add_user(new_usernames.next(), '')
-            self._db.commit_added_users()
+            except StoryTellingException:
+                pass  # username taken by a previous run
 
-            with io.open(tmp, encoding='utf-8') as buf:
-                self.add_lines(title, author, (line.strip() for line in buf))
+    def _imported_filenames(self):
+        # type: () -> Set[str]
+        return {filename for filename, in self._db.db.cursor.execute(
+            'SELECT filename FROM gutenberg_imports WHERE done')}
+
+    def _start_story(self, filename, title, author):
+        # type: (str, unicode, unicode) -> _IngestingStory
+        """Add the Story for a file, or resume it if a previous ingest was interrupted."""
+        cursor = self._db.db.cursor
+        cursor.execute('SELECT story_id, num_lines FROM gutenberg_imports WHERE filename = ?',
+                       [filename])
+        result = cursor.fetchone()
+        if result is not None:
+            story_id, num_lines = result
+            print(u'resuming {} after {} lines'.format(title, num_lines))
+            return _IngestingStory(Story(story_id, title), num_lines)
+
+        # the title is edited by user 1 and line i by user i + 2
+        self._ensure_users(1)
+        user = self._db.users[1]
+
+        def write():
+            # in one transaction, so a Story is never added without its progress
+            story_and_edit = self._db._add_new_story_hard(title, user, u'Title: ' + title)
+            self._db.db.cursor.execute('INSERT INTO gutenberg_imports VALUES (?, ?, 0, 0)',
+                                       [filename, story_and_edit[0].id])
+            return story_and_edit
+
+        story, edit = self._db._write(write)
+        self._db.cache_added_story(story, edit)
+        print(u'adding story {} by {} ({})'.format(title, author, utf8(filename)))
+        return _IngestingStory(story, 0)
+
+    def _add_story_lines(self, filename, ingesting, lines):
+        # type: (str, _IngestingStory, List[unicode]) -> int
+        """Insert and commit a chunk of lines of a Story, skipping lines already ingested."""
+        ingesting.num_received += len(lines)
+        num_skipped = len(lines) - (ingesting.num_received - ingesting.num_lines)
+        if num_skipped > 0:
+            lines = lines[num_skipped:]
+        if not lines:
+            return 0
+        first_uid = ingesting.num_lines + 2
+        self._ensure_users(first_uid + len(lines) - 1)
+        self._db.add_edits(ingesting.story, first_uid, lines)
+        ingesting.num_lines += len(lines)
+        self._db.db.cursor.execute(
+            'UPDATE gutenberg_imports SET num_lines = ? WHERE filename = ?',
+            [ingesting.num_lines, filename])
+        self._db.commit()
+        return len(lines)
+
+    def _finish_story(self, filename):
+        # type: (str) -> None
+        self._db.db.cursor.execute('UPDATE gutenberg_imports SET done = 1 WHERE filename = ?',
+                                   [filename])
+        self._db.commit()
+        self.num_stories_added += 1
 
-        finally:
-            os.remove(tmp)
+    def add_gutenberg_stories(self, dir='data/stories/', max_stories=float('inf'),
+                              num_workers=None, queue_size=DEFAULT_INGEST_QUEUE_SIZE,
+                              report_interval=DEFAULT_INGEST_REPORT_INTERVAL,
+                              stall_timeout=DEFAULT_INGEST_STALL_TIMEOUT):
+        # type: (str, Number, int | None, int, float, float) -> Iterable[str]
+        """
+        Ingest the Gutenberg stories in a directory, yielding each filename once it's added.
+
+        Files are parsed and normalized by a pool of `num_workers` processes
+        (default: one per CPU), which stream their lines in chunks through a queue
+        of at most `queue_size` chunks to this process, the single writer.
+        Each chunk is inserted and committed along with the file's progress
+        in the gutenberg_imports table, so an interrupted ingest resumes where it left off,
+        and files already ingested are skipped.
+        Progress and throughput are printed every `report_interval` seconds.
+        A parser process failing outside of a file, or dying (e.g. killed for memory)
+        so that nothing arrives for `stall_timeout` seconds, stops the ingest with an exception.
+        """
+        imported = self._imported_filenames()
+        filenames = [filename for filename in list_dir_txts(dir) if filename not in imported]
+        if max_stories != float('inf'):
+            filenames = list(islice(filenames, int(max_stories)))
+        if not filenames:
+            return
 
-    def add_gutenberg_stories(self, dir='data/stories/', max_stories=float('inf')):
-        # type: (str, Number) -> Iterable[str]
-        i = 1
-        for filename in list_dir_txts(dir):
-            try:
-                self.add_gutenberg_story(filename)
-                yield filename
-                i += 1
-                if i > max_stories:
+        queue = multiprocessing.Queue(queue_size)
+        pool = multiprocessing.Pool(num_workers, _init_parser, (queue,))
+        parsed = pool.map_async(_parse_gutenberg_story, filenames, chunksize=1)
+        pool.close()
+
+        stats = IngestStats(len(filenames))
+        self.ingest_stats = stats
+        ingesting = {}  # type: Dict[str, _IngestingStory]
+        with self._db.search_index_suspended(), _terminating(pool):
+            while stats.num_finished < stats.num_files:
+                kind, filename, value = _next_message(queue, parsed, stall_timeout)
+                try:
+                    if kind == STORY_START:
+                        ingesting[filename] = self._start_story(filename, *value)
+                    elif kind == STORY_LINES:
+                        if filename in ingesting:
+                            stats.num_lines += self._add_story_lines(
+                                filename, ingesting[filename], value)
+                    elif kind == STORY_END:
+                        if ingesting.pop(filename, None) is not None:
+                            self._finish_story(filename)
+                            stats.num_added += 1
+                            yield filename
+                        stats.num_finished += 1
+                    else:
+                        print('{}: {}'.format(filename, value), file=stderr)
+                        ingesting.pop(filename, None)
+                        stats.num_finished += 1
+                except StoryTellingException as e:
+                    print(e, file=stderr)
+                    ingesting.pop(filename, None)  # ignore the rest of this file
+                stats.maybe_report(report_interval)
+        stats.report()
+
+
+class _IngestingStory(object):
+    """A Story being ingested and how many of its lines (after the title) are in the DB."""
+
+    def __init__(self, story, num_lines):
+        # type: (Story, int) -> None
+        self.story = story
+        self.num_lines = num_lines
+        self.num_received = 0
+
+
+class IngestStats(object):
+    """Progress and throughput of `StoryBuilder.add_gutenberg_stories`."""
+
+    def __init__(self, num_files):
+        # type: (int) -> None
+        self.num_files = num_files
+        self.num_finished = 0
+        self.num_added = 0
+        self.num_lines = 0
+        self.start_time = timer()
+        self._last_report_time = self.start_time
+
+    @property
+    def elapsed(self):
+        # type: () -> float
+        return timer() - self.start_time
+
+    def report(self):
+        # type: () -> None
+        elapsed = self.elapsed
+        print('ingested {}/{} files ({} added), {} lines in {:.1f} s ({:.0f} lines/s)'.format(
+            self.num_finished, self.num_files, self.num_added, self.num_lines, elapsed,
+            self.num_lines / elapsed if elapsed else 0))
+
+    def maybe_report(self, interval):
+        # type: (float) -> None
+        now = timer()
+        if now - self._last_report_time >= interval:
+            self._last_report_time = now
+            self.report()
+
+
+"""Kinds of messages put on the ingest queue by `_parse_gutenberg_story`."""
+STORY_START = 'start'  # value is (title, author)
+STORY_LINES = 'lines'  # value is a chunk of lines
+STORY_END = 'end'
+STORY_ERROR = 'error'  # value is the error message
+
+_ingest_queue = None  # type: multiprocessing.Queue
+
+
+@contextmanager
+def _terminating(pool):
+    # type: (multiprocessing.Pool) -> None
+    """Stop the pool's processes when done, even if the ingest is stopped early."""
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _next_message(queue, parsed, stall_timeout):
+    # type: (multiprocessing.Queue, AsyncResult, float) -> Tuple[str, str, Any]
+    """
+    Get the next message of the parser processes, raising the exception of a failed one,
+    or an IngestStalledException if none arrives for `stall_timeout` seconds.
+    """
+    deadline = timer() + stall_timeout
+    while True:
+        try:
+            return queue.get(timeout=INGEST_POLL_INTERVAL)
+        except Empty:
+            if parsed.ready() and not parsed.successful():
+                parsed.get()  # raises the parser's exception
+            if timer() >= deadline:
+                raise IngestStalledException(
+                    'no progress from the parsers in {:.0f} seconds'.format(stall_timeout))
+
+
+def _init_parser(queue):
+    # type: (multiprocessing.Queue) -> None
+    """Initialize a parser process with the ingest queue."""
+    global _ingest_queue
+    _ingest_queue = queue
+
+
+def _parse_gutenberg_story(filename):
+    # type: (str) -> None
+    """
+    Parse a Gutenberg story file in a parser process,
+    putting its title and author and then its non-empty, stripped lines in chunks
+    on the ingest queue.
+    """
+    queue = _ingest_queue
+    try:
+        with open(filename) as f:
+            title, author = StoryBuilder.find_author_title(f)
+            while True:
+                line = f.readline()
+                if not line:
+                    raise BadGutenbergStoryHeaderException('no start of text in ' + filename)
+                if line[:3] == '***':
                     break
-            except (BadGutenbergStoryHeaderException, StoryTellingException, Exception) as e:
-                print(e, file=stderr)
-                self.num_stories_added -= 1
+            queue.put((STORY_START, filename, (title, author)))
+            chunk = []  # type: List[unicode]
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                chunk.append(utf8(line))
+                if len(chunk) == INGEST_CHUNK_SIZE:
+                    queue.put((STORY_LINES, filename, chunk))
+                    chunk = []
+            if chunk:
+                queue.put((STORY_LINES, filename, chunk))
+        queue.put((STORY_END, filename, None))
+    except Exception as e:
+        queue.put((STORY_ERROR, filename, '{}: {}'.format(type(e).__name__, e)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+"""
+Cache of the rendered HTML of each Story's Edits, for read_story.jinja2.
+
+Edits are append-only and ordered by id, so the HTML rendered for a Story
+up to some edit id never changes.  A cached Story is only extended
+with the Edits after its last cached edit id, each rendered on its own
+through the macros in edit_fragments.jinja2, instead of re-rendering the whole Story.
+The new Edits are appended as one more chunk of HTML,
+written out in turn by read_story.jinja2, so the cached HTML is never copied.
+"""
+
+import sys
+import threading
+from timeit import default_timer as timer
+
+from jinja2 import Environment
+from markupsafe import Markup
+from typing import Any, Dict, List, Set, Tuple
+
+from storytelling_db import StoryTellingDatabase, Story, EDIT_PAGE_SIZE
+from util.cache import SizedLRUCache, CACHE_LOOKUPS
+from util.metrics import Counter
+from util.namedtuple_factory import namedtuple
+
+"""Maximum total size of the cached fragments, in bytes."""
+DEFAULT_FRAGMENT_CACHE_BYTES = 64 * 1024 * 1024
+"""Maximum size of the fragments of one Story; larger Stories are streamed instead."""
+DEFAULT_MAX_STORY_BYTES = 8 * 1024 * 1024
+
+FRAGMENTS_TEMPLATE = 'edit_fragments.jinja2'
+
+RENDER_SECONDS = Counter('storytelling_fragment_render_seconds_total',
+                         'Seconds spent rendering the fragments of Edits')
+RENDER_SECONDS_SAVED = Counter('storytelling_fragment_render_seconds_saved_total',
+                               'Seconds of rendering saved by reusing cached fragments')
+
+StoryFragments = namedtuple('StoryFragments',
+                            ['story', 'last_rowid', 'texts', 'rows', 'size', 'render_seconds'])
+# type: (Story, int, Tuple[Markup, ...], Tuple[Markup, ...], int, float)
+StoryFragments.__repr__ = lambda self: 'StoryFragments(%r, %s)' % self[:2]
+
+
+class StoryFragmentCache(object):
+    """
+    The rendered paragraphs (`texts`) and table rows (`rows`) of Stories' Edits,
+    as chunks of HTML, by story id, in a `SizedLRUCache` of at most `max_bytes`.
+
+    `get()` renders only the Edits added since a Story was cached,
+    and given the Story's current version, doesn't even query for them if there are none.
+    Each entry keeps the seconds spent rendering it, which are counted as saved
+    whenever it's reused, in whole or extended.
+    Stories over `max_story_bytes` aren't cached and `get()` returns None for them,
+    so they can be streamed instead.
+    Since Stories only grow, they're remembered as too large until `clear()`.
+    """
+
+    def __init__(self, db, jinja_env, max_bytes=DEFAULT_FRAGMENT_CACHE_BYTES,
+                 max_story_bytes=DEFAULT_MAX_STORY_BYTES, page_size=EDIT_PAGE_SIZE):
+        # type: (StoryTellingDatabase, Environment, int, int, int) -> None
+        self.name = 'fragments'
+        self.db = db
+        self.jinja_env = jinja_env
+        self.max_story_bytes = max_story_bytes
+        self.page_size = page_size
+        self._cache = SizedLRUCache(self.name, max_bytes)
+        self._too_large = set()  # type: Set[int]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.extensions = 0
+        self.misses = 0
+        self.render_seconds = 0.0
+        self.render_seconds_saved = 0.0
+        self._counters = {result: CACHE_LOOKUPS.labels(self.name, result)
+                          for result in ('hit', 'extend', 'miss')}
+
+    def _count(self, result, render_seconds, render_seconds_saved):
+        # type: (str, float, float) -> None
+        with self._lock:
+            if result == 'hit':
+                self.hits += 1
+            elif result == 'extend':
+                self.extensions += 1
+            else:
+                self.misses += 1
+            self.render_seconds += render_seconds
+            self.render_seconds_saved += render_seconds_saved
+        self._counters[result].inc()
+        RENDER_SECONDS.inc(render_seconds)
+        RENDER_SECONDS_SAVED.inc(render_seconds_saved)
+
+    def get(self, story, version=None):
+        # type: (Story, int | None) -> StoryFragments | None
+        """
+        Get the fragments of all the Edits of `story`, rendering the ones not yet cached,
+        or None if `story` is too large to cache.
+
+        `version` is the id of the Story's last Edit, if the caller already has it
+        (see `StoryTellingDatabase.get_story_version`):
+        a cached Story that's as current is returned without querying for new Edits.
+        """
+        if story.id in self._too_large:
+            return None
+        cached = self._cache.get(story.id)
+        if cached is not None and cached.story != story:
+            cached = None  # the story id was reused after the tables were cleared
+        if cached is not None and version is not None and cached.last_rowid >= version:
+            self._count('hit', 0.0, cached.render_seconds)
+            return cached
+        if cached is None:
+            last_rowid, texts, rows, size, render_seconds = 0, (), (), 0, 0.0
+        else:
+            _, last_rowid, texts, rows, size, render_seconds = cached
+        fragments = self.jinja_env.get_template(FRAGMENTS_TEMPLATE).module
+        new_texts = []  # type: List[Markup]
+        new_rows = []  # type: List[Markup]
+        new_render_seconds = 0.0
+        while True:
+            with self.db:
+                edits, next_rowid = self.db.get_edit_page(story, last_rowid, self.page_size)
+            start = timer()
+            page_texts = [fragments.paragraph(edit) for edit in edits]
+            page_rows = [fragments.row(edit) for edit in edits]
+            new_render_seconds += timer() - start
+            size += sum(sys.getsizeof(fragment) for fragment in page_texts + page_rows)
+            if size > self.max_story_bytes:
+                self._too_large.add(story.id)
+                self._cache.invalidate(story.id)
+                self._count('miss', new_render_seconds, 0.0)
+                return None
+            new_texts.extend(page_texts)
+            new_rows.extend(page_rows)
+            last_rowid = next_rowid
+            if len(edits) < self.page_size:
+                break
+
+        if cached is not None and not new_texts:
+            self._count('hit', 0.0, cached.render_seconds)
+            return cached
+        story_fragments = StoryFragments(story, last_rowid,
+                                         texts + (Markup(u''.join(new_texts)),),
+                                         rows + (Markup(u''.join(new_rows)),),
+                                         size, render_seconds + new_render_seconds)
+        self._cache.put(story.id, story_fragments, size)
+        self._count('miss' if cached is None else 'extend', new_render_seconds, render_seconds)
+        return story_fragments
+
+    def invalidate(self, story_id):
+        # type: (int) -> None
+        self._cache.invalidate(story_id)
+
+    def clear(self):
+        # type: () -> None
+        self._cache.clear()
+        self._too_large.clear()
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """
+        Size and bytes of the cache, hits, extensions (partial hits), misses,
+        and seconds spent and saved rendering.
+        """
+        stats = self._cache.stats()
+        with self._lock:
+            lookups = self.hits + self.extensions + self.misses
+            stats.update(
+                hits=self.hits,
+                extensions=self.extensions,
+                misses=self.misses,
+                too_large=len(self._too_large),
+                hit_rate=float(self.hits + self.extensions) / lookups if lookups else 0.0,
+                render_seconds=self.render_seconds,
+                render_seconds_saved=self.render_seconds_saved,
+            )
+        return stats
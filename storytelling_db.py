@@ -1,12 +1,19 @@
 from __future__ import print_function
 
-from datetime import datetime
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from sys import stderr
 
 import dateutil.parser
 from passlib.hash import pbkdf2_sha256
-from typing import Generator, Tuple, Union
+from typing import Callable, Dict, Generator, Iterable, List, Tuple, TypeVar, Union
 
-from util.db import Database
+from util.cache import LRUCache
+from util.db import Database, GroupCommitter, DEFAULT_POOL_SIZE, DEFAULT_GROUP_COMMIT_SIZE
+from util.metrics import Histogram
 from util.namedtuple_factory import namedtuple
 
 DB_SCHEMA = dict(
@@ -35,8 +42,272 @@ DB_SCHEMA = dict(
             FOREIGN KEY (story_id) REFERENCES stories(id),
             FOREIGN KEY (user_id) REFERENCES users(id)
         )''',
+
+    schema_migrations='''
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INTEGER PRIMARY KEY,
+            time TEXT NOT NULL
+        )''',
 )
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_time(time):
+    # type: (datetime) -> int
+    """Encode a (naive) datetime as integer microseconds since `EPOCH`."""
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_time(time):
+    # type: (int | long | unicode) -> datetime
+    """
+    Decode a time encoded by `encode_time`.
+
+    Falls back to parsing ISO strings for rows the timestamp migration hasn't reached yet.
+    """
+    if isinstance(time, (int, long)):
+        return EPOCH + timedelta(microseconds=time)
+    return dateutil.parser.parse(time)
+
+
+TIMESTAMP_BACKFILL_CHUNK = 10000
+
+# same as encode_time(dateutil.parser.parse(iso_time)) for datetime.isoformat() strings
+_ISO_TO_TIMESTAMP_SQL = (
+    "CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 "
+    "+ CAST(substr({0} || '.000000', 21, 6) AS INTEGER)")
+
+
+def _backfill_timestamps(db):
+    # type: (Database) -> None
+    """
+    Convert ISO `start_time`/`time` columns to their integer `*_us` columns.
+
+    Runs in ROWID chunks, each committed separately, so it can be interrupted and resumed.
+    It runs at startup rather than in the background, since later migrations
+    (the story_summary seed) and the reads of the `*_us` columns need every row converted.
+    """
+    for table, column in (('users', 'start_time'), ('stories', 'start_time'), ('edits', 'time')):
+        sql = 'UPDATE {0} SET {1}_us = {2} WHERE ROWID > ? AND ROWID <= ? AND {1}_us IS NULL' \
+            .format(table, column, _ISO_TO_TIMESTAMP_SQL.format(column))
+        db.cursor.execute('SELECT max(ROWID) FROM {}'.format(table))
+        max_rowid = db.cursor.fetchone()[0] or 0
+        for start in xrange(0, max_rowid, TIMESTAMP_BACKFILL_CHUNK):
+            db.cursor.execute(sql, [start, start + TIMESTAMP_BACKFILL_CHUNK])
+            db.commit()
+
+
+"""Full-text search index (FTS5) over storynames and edit text, see `StoryTellingDatabase.search`."""
+SEARCH_TABLES = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS stories_search
+        USING fts5(storyname, content='stories', content_rowid='id')''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS edits_search
+        USING fts5(text, content='edits')''',
+]  # type: List[str]
+
+"""Triggers incrementally updating the search index, keyed by name so they can be suspended."""
+SEARCH_TRIGGERS = dict(
+    stories_search_insert='''
+        CREATE TRIGGER IF NOT EXISTS stories_search_insert AFTER INSERT ON stories
+        BEGIN
+            INSERT INTO stories_search(rowid, storyname) VALUES (NEW.id, NEW.storyname);
+        END''',
+    edits_search_insert='''
+        CREATE TRIGGER IF NOT EXISTS edits_search_insert AFTER INSERT ON edits
+        BEGIN
+            INSERT INTO edits_search(rowid, text) VALUES (NEW.id, NEW.text);
+        END''',
+)
+
+
+def rebuild_search_index(db):
+    # type: (Database) -> None
+    """Rebuild the whole search index from the stories and edits tables."""
+    db.cursor.execute("INSERT INTO stories_search(stories_search) VALUES ('rebuild')")
+    db.cursor.execute("INSERT INTO edits_search(edits_search) VALUES ('rebuild')")
+
+
+def restore_search_triggers(db):
+    # type: (Database) -> None
+    """
+    Recreate any missing `SEARCH_TRIGGERS` and rebuild the search index,
+    after a bulk import with them suspended was interrupted
+    (see `PrivilegedStoryTellingDatabase.search_index_suspended`).
+    The index misses whatever was imported while they were dropped, hence the rebuild.
+    """
+    if not db.table_exists('edits_search'):
+        return
+    db.cursor.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({})".format(
+            ', '.join('?' * len(SEARCH_TRIGGERS))),
+        list(SEARCH_TRIGGERS))
+    if db.cursor.fetchone()[0] == len(SEARCH_TRIGGERS):
+        return
+    print('search index triggers missing, rebuilding the index', file=stderr)
+    map(db.cursor.execute, SEARCH_TRIGGERS.viewvalues())
+    rebuild_search_index(db)
+
+
+def _create_search_index(db):
+    # type: (Database) -> None
+    """Create and fill the search index, or skip it if SQLite wasn't built with FTS5."""
+    try:
+        map(db.cursor.execute, SEARCH_TABLES)
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in e.message:
+            raise
+        print('search disabled: {}'.format(e), file=stderr)
+        return
+    map(db.cursor.execute, SEARCH_TRIGGERS.viewvalues())
+    rebuild_search_index(db)
+
+
+"""Duplicate values shown in the error of `_create_unique_index`."""
+MAX_REPORTED_DUPLICATES = 10
+
+
+def _create_unique_index(name, table, column):
+    # type: (str, str, str) -> Callable[[Database], None]
+    """
+    A migration creating a unique index on `table(column)`.
+
+    Databases from before the index may hold duplicates (the check before inserting raced),
+    which would fail it with an opaque IntegrityError, so they're looked up first
+    and reported in a StoryTellingException, leaving it to an admin to rename or remove them.
+    """
+    def create_unique_index(db):
+        # type: (Database) -> None
+        db.cursor.execute(
+            'SELECT {1}, count(*) FROM {0} GROUP BY {1} HAVING count(*) > 1'.format(table, column))
+        duplicates = db.cursor.fetchall()
+        if duplicates:
+            raise StoryTellingException(
+                u'can\'t create unique index {} on {}({}), {} values are duplicated: {}{}'.format(
+                    name, table, column, len(duplicates),
+                    ', '.join(u'"{}" ({} rows)'.format(value, count)
+                              for value, count in duplicates[:MAX_REPORTED_DUPLICATES]),
+                    ', ...' if len(duplicates) > MAX_REPORTED_DUPLICATES else ''))
+        with db.transaction():
+            db.cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS {} ON {}({})'.format(
+                name, table, column))
+
+    return create_unique_index
+
+
+"""
+Rebuild of the edits table with an explicit `id INTEGER PRIMARY KEY`, see `_add_edit_ids`.
+(story_id, user_id) stays unique, in place of the primary key.
+"""
+EDITS_WITH_ID = [
+    '''
+    CREATE TABLE edits_with_id(
+        id INTEGER PRIMARY KEY,
+        story_id INTEGER,
+        user_id INTEGER,
+        text TEXT NOT NULL,
+        time TEXT NOT NULL,
+        time_us INTEGER,
+        UNIQUE (story_id, user_id),
+        FOREIGN KEY (story_id) REFERENCES stories(id),
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )''',
+    '''
+    INSERT INTO edits_with_id (id, story_id, user_id, text, time, time_us)
+        SELECT ROWID, story_id, user_id, text, time, time_us FROM edits ORDER BY ROWID''',
+    'DROP TABLE edits',
+    'ALTER TABLE edits_with_id RENAME TO edits',
+    'CREATE INDEX edits_story_id ON edits(story_id)',
+    'CREATE INDEX edits_user_id_story_id ON edits(user_id, story_id)',
+    '''
+    CREATE TRIGGER edits_story_summary AFTER INSERT ON edits
+    BEGIN
+        INSERT OR IGNORE INTO story_summary VALUES (NEW.story_id, NEW.id, 0, NULL, NEW.user_id);
+        UPDATE story_summary SET
+            last_edit_rowid = NEW.id,
+            edit_count = edit_count + 1,
+            last_edit_time_us = NEW.time_us,
+            last_editor_id = NEW.user_id
+            WHERE story_id = NEW.story_id;
+    END''',
+]  # type: List[str]
+
+
+def _add_edit_ids(db):
+    # type: (Database) -> None
+    """
+    Give edits an explicit `id` aliasing its ROWID, which VACUUM could otherwise renumber,
+    breaking story_summary.last_edit_rowid, the ETags and cursors made of it,
+    and edits_search, whose rowids are those of edits.
+    The ids are the current ROWIDs, so none of those change.
+    """
+    db.cursor.execute('PRAGMA table_info(edits)')
+    if any(column == 'id' for _, column, _, _, _, _ in db.cursor.fetchall()):
+        return  # rebuilt by an interrupted run
+    with db.transaction():
+        map(db.cursor.execute, EDITS_WITH_ID)
+        if db.table_exists('edits_search'):
+            db.cursor.execute(SEARCH_TRIGGERS['edits_search_insert'])
+
+
+"""
+Ordered schema migrations, applied after `DB_SCHEMA` by `StoryTellingDatabase._create_tables`.
+Migration i (1-indexed) brings the schema to version i.  Only ever append to this list.
+A migration is either an SQL statement or a function taking the `Database`.
+"""
+MIGRATIONS = [
+    _create_unique_index('users_username', 'users', 'username'),
+    _create_unique_index('stories_storyname', 'stories', 'storyname'),
+    # (story_id, ROWID): an edits' story in ROWID order, so the last edit is one index seek
+    'CREATE INDEX IF NOT EXISTS edits_story_id ON edits(story_id)',
+    'CREATE INDEX IF NOT EXISTS edits_user_id ON edits(user_id)',
+    # integer times (see encode_time), read in place of the ISO text columns
+    'ALTER TABLE users ADD COLUMN start_time_us INTEGER',
+    'ALTER TABLE stories ADD COLUMN start_time_us INTEGER',
+    'ALTER TABLE edits ADD COLUMN time_us INTEGER',
+    _backfill_timestamps,
+    # per-story last edit and edit count, kept current by the trigger below
+    '''
+    CREATE TABLE IF NOT EXISTS story_summary(
+        story_id INTEGER PRIMARY KEY,
+        last_edit_rowid INTEGER NOT NULL,
+        edit_count INTEGER NOT NULL,
+        last_edit_time_us INTEGER,
+        last_editor_id INTEGER NOT NULL,
+        FOREIGN KEY (story_id) REFERENCES stories(id),
+        FOREIGN KEY (last_editor_id) REFERENCES users(id)
+    )''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS edits_story_summary AFTER INSERT ON edits
+    BEGIN
+        INSERT OR IGNORE INTO story_summary VALUES (NEW.story_id, NEW.ROWID, 0, NULL, NEW.user_id);
+        UPDATE story_summary SET
+            last_edit_rowid = NEW.ROWID,
+            edit_count = edit_count + 1,
+            last_edit_time_us = NEW.time_us,
+            last_editor_id = NEW.user_id
+            WHERE story_id = NEW.story_id;
+    END''',
+    '''
+    INSERT OR REPLACE INTO story_summary
+        SELECT last.story_id, last.rowid, last.edit_count, edits.time_us, edits.user_id
+            FROM (SELECT story_id, max(ROWID) AS rowid, count(*) AS edit_count
+                    FROM edits GROUP BY story_id) AS last, edits
+            WHERE edits.ROWID = last.rowid''',
+    # (user_id, story_id): a user's edited stories in story id order, for keyset pagination
+    'CREATE INDEX IF NOT EXISTS edits_user_id_story_id ON edits(user_id, story_id)',
+    'DROP INDEX IF EXISTS edits_user_id',
+    _create_search_index,
+    _add_edit_ids,
+]  # type: List[Union[str, Callable[[Database], None]]]
+
+EDIT_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024  # bytes
+DEFAULT_CACHE_SIZE = -16 * 1024  # negative means KiB
+
 password_hasher = pbkdf2_sha256.using(rounds=16)
 
 
@@ -52,17 +323,127 @@ def verify_password(plain_password, hashed_password):
     return password_hasher.verify(plain_password, hashed_password)
 
 
-User = namedtuple('User', ['id', 'username'])  # type: (int, unicode)
+DEFAULT_PASSWORD_WORKERS = 2
+DEFAULT_MAX_PENDING_PASSWORDS = 32
+
+PASSWORD_SECONDS = Histogram('storytelling_password_seconds',
+                             'Seconds spent hashing or verifying a password on a worker',
+                             ['operation'])
+
+
+def _timed(histogram, func, *args):
+    with histogram.time():
+        return func(*args)
+
+
+class PasswordWorkers(object):
+    """
+    Bounded thread pool hashing and verifying passwords,
+    so the work is done outside of any DB lock or pooled connection
+    and at most `num_workers` threads burn CPU on it at once.
+
+    At most `max_pending` hashes can be running or queued.
+    Beyond that, a StoryTellingException is raised immediately,
+    so a login storm can't starve the other routes.
+    """
+
+    def __init__(self, num_workers=DEFAULT_PASSWORD_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING_PASSWORDS):
+        # type: (int, int) -> None
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPool(num_workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, operation, func, *args):
+        if not self._pending.acquire(False):
+            raise StoryTellingException('server busy, try again later')
+        try:
+            return self._pool.apply(_timed, (PASSWORD_SECONDS.labels(operation), func) + args)
+        finally:
+            self._pending.release()
+
+    def hash(self, plain_password):
+        # type: (unicode) -> str | unicode
+        """Securely hash password on a worker thread."""
+        return self._run('hash', hash_password, plain_password)
+
+    def verify(self, plain_password, hashed_password):
+        # type: (unicode, unicode) -> bool
+        """Verify if plain password matches the hashed password on a worker thread."""
+        return self._run('verify', verify_password, plain_password, hashed_password)
+
+    def close(self):
+        # type: () -> None
+        self._pool.close()
+        self._pool.join()
+
+
+User = namedtuple('User', ['id', 'username'], tag=1)  # type: (int, unicode)
 User.__repr__ = lambda self: 'User(%s, %s)' % self
 
-Story = namedtuple('Story', ['id', 'storyname'])  # type: (int, unicode)
+Story = namedtuple('Story', ['id', 'storyname'], tag=2)  # type: (int, unicode)
 Story.__repr__ = lambda self: 'Story(%s, %s)' % self
 
 Edit = namedtuple('Edit',
-                  ['story', 'user', 'text', 'time'])  # type: (Story, User, unicode, datetime)
+                  ['story', 'user', 'text', 'time'], tag=3)  # type: (Story, User, unicode, datetime)
 Edit.__repr__ = lambda self: 'Edit(%r, %r, %s, %s)' % self
 Edit.order = lambda self: self.time  # type: Edit -> datetime
 
+StorySummary = namedtuple('StorySummary',
+                          ['story', 'edit_count', 'last_edit_time', 'last_editor'], tag=4)
+# type: (Story, int, datetime, User)
+StorySummary.__repr__ = lambda self: 'StorySummary(%r, %s, %s, %r)' % self
+
+
+T = TypeVar('T')
+
+"""Maximum number of each of Users, Stories and Edits in the `IdentityMap`."""
+DEFAULT_IDENTITY_MAP_SIZE = 100000
+"""Maximum number of entries in each of the lookup caches."""
+DEFAULT_LOOKUP_CACHE_SIZE = 10000
+"""Seconds an entry of the lookup caches lives, so other processes' writes show up."""
+DEFAULT_LOOKUP_CACHE_TTL = 5.0
+
+
+class IdentityMap(object):
+    """
+    The one User, Story and Edit of each id, shared by everything built from a row,
+    so recurring ones and their strings aren't duplicated across rows and requests,
+    e.g. a story read by several requests at once holds one copy of its Edits.
+    (User, Story and Edit are namedtuples, so they already have empty `__slots__`.)
+
+    Usernames, storynames and edits never change, so entries never go stale
+    (unless the tables are cleared), and they're kept in `LRUCache`s without a ttl,
+    each of at most `size` entries.  With `size` 0, it's disabled.
+    """
+
+    def __init__(self, size=DEFAULT_IDENTITY_MAP_SIZE):
+        # type: (int) -> None
+        self.users = LRUCache('identity_map_users', size)  # by user id
+        self.stories = LRUCache('identity_map_stories', size)  # by story id
+        self.edits = LRUCache('identity_map_edits', size)  # by edit id
+        self.caches = [self.users, self.stories, self.edits]
+
+    def user(self, user_id, username):
+        # type: (int, unicode) -> User
+        """Get the User with the given id, creating it with the given username if needed."""
+        return self.users.get(user_id, lambda: User(user_id, username))
+
+    def story(self, story_id, storyname):
+        # type: (int, unicode) -> Story
+        """Get the Story with the given id, creating it with the given storyname if needed."""
+        return self.stories.get(story_id, lambda: Story(story_id, storyname))
+
+    def edit(self, edit_id, story, user_id, username, text, time):
+        # type: (int, Story, int, unicode, unicode, int | long | unicode) -> Edit
+        """
+        Get the Edit with the given id, creating it from the rest of its row if needed,
+        with its time as read (decoded by `decode_time`).
+        """
+        return self.edits.get(edit_id, lambda: Edit(
+            story, self.user(user_id, username), text, decode_time(time)))
+
 
 class StoryTellingException(Exception):
     """An Exception thrown by StoryTellingDatabase."""
@@ -77,39 +458,105 @@ class StoryTellingDatabase(object):
 
     :ivar db: low level database object
     :type db: Database
+
+    The DB is opened in WAL mode.
+    Reads inside `with db:` run in parallel on pooled read-only connections
+    and never wait on the writer.
+    All writes are serialized through `Database.writing()`,
+    or, if `group_commit_interval` (seconds) is given,
+    batched into shared transactions by a `GroupCommitter`.
+    Passwords are hashed and verified by `PasswordWorkers`, outside of any lock.
+
+    `get_story`, `get_last_edit` and `can_edit` are cached in `LRUCache`s
+    of `lookup_cache_size` entries each.
+    Writes invalidate the entries they change both when they're made and once committed,
+    so no concurrent read can re-cache what they changed.
+    Only this process's writes invalidate entries, so with other processes writing
+    (e.g. several app processes, or an import) entries expire after `lookup_cache_ttl` seconds,
+    how stale a lookup can then get.  With `lookup_cache_ttl` None, they never expire,
+    which is only correct if this is the only process writing to the DB.
+    Even a stale `can_edit` can't allow a second Edit of a Story by a User,
+    since the insert itself is checked (see `edit_story`).
     """
 
-    def __init__(self, path='data/storytelling.db'):
-        # type: (Union[str, unicode]) -> None
+    def __init__(self, path='data/storytelling.db', pool_size=DEFAULT_POOL_SIZE,
+                 mmap_size=DEFAULT_MMAP_SIZE, cache_size=DEFAULT_CACHE_SIZE,
+                 group_commit_interval=None, group_commit_size=DEFAULT_GROUP_COMMIT_SIZE,
+                 password_workers=DEFAULT_PASSWORD_WORKERS,
+                 max_pending_passwords=DEFAULT_MAX_PENDING_PASSWORDS, slow_query_threshold=None,
+                 identity_map_size=DEFAULT_IDENTITY_MAP_SIZE,
+                 lookup_cache_size=DEFAULT_LOOKUP_CACHE_SIZE,
+                 lookup_cache_ttl=DEFAULT_LOOKUP_CACHE_TTL):
+        # type: (Union[str, unicode], int, int | None, int | None, float | None, int, int, int, float | None, int, int, float | None) -> None
         """Create DB with given name and open low level connection through `Database`"""
         self.name = path
-        self.db = Database(path)
+        self.identity_map = IdentityMap(identity_map_size)
+        self.story_cache = LRUCache('story', lookup_cache_size, lookup_cache_ttl)  # by storyname
+        self.last_edit_cache = LRUCache('last_edit', lookup_cache_size,
+                                        lookup_cache_ttl)  # by story id
+        self.can_edit_cache = LRUCache('can_edit', lookup_cache_size,
+                                       lookup_cache_ttl)  # by (story id, user id)
+        # caches of data derived from the DB can be added, to be cleared along with these
+        self.caches = [self.story_cache, self.last_edit_cache, self.can_edit_cache] \
+            + self.identity_map.caches
+        self._write_local = threading.local()
+        self.password_workers = PasswordWorkers(password_workers, max_pending_passwords)
+        self.db = Database(path, pool_size=pool_size, wal=True,
+                           mmap_size=mmap_size, cache_size=cache_size,
+                           slow_query_threshold=slow_query_threshold)
         self._create_tables()
+        self.group_committer = None  # type: GroupCommitter
+        if group_commit_interval is not None:
+            self.group_committer = GroupCommitter(self.db, group_commit_interval,
+                                                  group_commit_size)
 
     def commit(self):
         # type: () -> None
         """Commit DB."""
         self.db.commit()
 
+    def stats(self):
+        # type: () -> Dict[str, float]
+        """
+        Stats of the `Database` (pool, write lock, queries),
+        with `transactions` counting both direct and group commits.
+        """
+        stats = self.db.stats()
+        stats['transactions'] = stats['commits']
+        if self.group_committer is not None:
+            group_stats = self.group_committer.stats()
+            stats['transactions'] += group_stats['commits']
+            stats['group_commit_writes'] = group_stats['writes']
+        return stats
+
+    def _stop_workers(self):
+        # type: () -> None
+        self.password_workers.close()
+        if self.group_committer is not None:
+            self.group_committer.close()
+            self.group_committer = None
+
     def hard_close(self):
         # type: () -> None
         """Close DB without committing."""
+        self._stop_workers()
         self.db.hard_close()
 
     def close(self):
         # type: () -> None
         """Close and commit DB."""
+        self._stop_workers()
         self.commit()
         self.db.hard_close()
 
     def lock(self):
         # type: () -> None
-        """Acquire reentrant lock. By locking, multithreaded to DB is safe."""
+        """Check out a pooled connection (reentrant). By locking, multithreaded to DB is safe."""
         self.db.lock()
 
     def release_lock(self):
         # type: () -> None
-        """Release reentrant lock."""
+        """Release reentrant lock, checking the pooled connection back in."""
         self.db.release_lock()
 
     def __enter__(self):
@@ -125,17 +572,68 @@ class StoryTellingDatabase(object):
 
     def _create_tables(self):
         # type: () -> None
-        """Create all tables according to `DB_SCHEMA`."""
-        map(self.db.cursor.execute, DB_SCHEMA.viewvalues())
-        self.db.commit()
+        """
+        Create all tables according to `DB_SCHEMA`, apply pending `MIGRATIONS`
+        and restore the search index if an import left it without its triggers.
+        """
+        with self.db.writing():
+            map(self.db.cursor.execute, DB_SCHEMA.viewvalues())
+            self.db.commit()
+            self._migrate()
+            restore_search_triggers(self.db)
+            self.db.commit()
+
+    @property
+    def schema_version(self):
+        # type: () -> int
+        """Version of the last migration applied, or 0 if none have been."""
+        self.db.cursor.execute('SELECT max(version) FROM schema_migrations')
+        return self.db.cursor.fetchone()[0] or 0
+
+    def _migrate(self):
+        # type: () -> None
+        """
+        Apply every migration in `MIGRATIONS` newer than `schema_version`, in order.
+
+        An SQL migration is recorded in schema_migrations in the same transaction,
+        so it's never half applied.  A function migration manages its own transactions
+        and is recorded once it returns, so it must be safe to rerun if interrupted.
+        """
+        with self.db.writing():
+            start = self.schema_version
+            for version, migration in enumerate(MIGRATIONS[start:], start + 1):
+                if callable(migration):
+                    migration(self.db)
+                with self.db.transaction():
+                    if not callable(migration):
+                        self.db.cursor.execute(migration)
+                    self.db.cursor.execute('INSERT INTO schema_migrations VALUES (?, ?)',
+                                           [version, datetime.now().isoformat()])
 
     def clear(self):
         # type: () -> None
         """Drop and recreate tables."""
-        self.db.cursor.executescript(
-            ''.join('DROP TABLE {};'.format(table) for table in DB_SCHEMA))
-        self._create_tables()
-        self.commit()
+        with self.db.writing():
+            # virtual tables first, since dropping them drops their shadow tables
+            self.db.cursor.execute(
+                'SELECT name FROM sqlite_master WHERE type = "table" AND name NOT LIKE "sqlite_%" '
+                'ORDER BY sql LIKE "CREATE VIRTUAL TABLE%" DESC')
+            tables = [table for table, in self.db.cursor.fetchall()]
+            self.db.cursor.executescript(
+                ''.join('DROP TABLE IF EXISTS {};'.format(table) for table in tables))
+            self._create_tables()
+            self.commit()
+        self.clear_caches()  # ids will be reused
+
+    def clear_caches(self):
+        # type: () -> None
+        for cache in self.caches:
+            cache.clear()
+
+    def cache_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        """Size, hits, misses, evictions and hit rate of each cache, by name."""
+        return {cache.name: cache.stats() for cache in self.caches}
 
     def reset_connection(self):
         self.db.reset_connection()
@@ -147,15 +645,18 @@ class StoryTellingDatabase(object):
 
         If username doesn't exist or password doesn't match,
         raise `StoryTellingException` with a message.
+
+        Only the lookup uses a pooled connection; the password is verified after releasing it.
         """
-        self.db.cursor.execute('SELECT id, password FROM users WHERE username = ?', [username])
-        result = self.db.cursor.fetchone()
+        with self:
+            self.db.cursor.execute('SELECT id, password FROM users WHERE username = ?', [username])
+            result = self.db.cursor.fetchone()
         if result is None:
             raise StoryTellingException('username "{}" doesn\'t exist'.format(username))
         user_id, hashed_password = result
-        if not verify_password(password, hashed_password):
+        if not self.password_workers.verify(password, hashed_password):
             raise StoryTellingException('wrong password for username "{}"'.format(username))
-        return User(user_id, username)
+        return self.identity_map.user(user_id, username)
 
     def verify_user(self, username, password):
         # type: (unicode, unicode) -> bool
@@ -182,12 +683,41 @@ class StoryTellingDatabase(object):
         If story with given storyname doesn't exist,
         raise `StoryTellingException` with a message.
         """
-        self.db.cursor.execute('SELECT id FROM stories WHERE storyname = ?', [storyname])
+
+        def load():
+            self.db.cursor.execute('SELECT id FROM stories WHERE storyname = ?', [storyname])
+            result = self.db.cursor.fetchone()
+            if result is None:
+                raise StoryTellingException('story "{}" doesn\'t exist'.format(storyname))
+            return self.identity_map.story(result[0], storyname)
+
+        return self.story_cache.get(storyname, load)
+
+    def get_story_by_id(self, story_id):
+        # type: (int) -> Story
+        """
+        Get Story with given id.
+
+        If story with given id doesn't exist,
+        raise `StoryTellingException` with a message.
+        """
+        self.db.cursor.execute('SELECT storyname FROM stories WHERE id = ?', [story_id])
         result = self.db.cursor.fetchone()
         if result is None:
-            raise StoryTellingException('story "{}" doesn\'t exist'.format(storyname))
-        story_id = result[0]
-        return Story(story_id, storyname)
+            raise StoryTellingException('story {} doesn\'t exist'.format(story_id))
+        return self.identity_map.story(story_id, result[0])
+
+    def get_stories(self, after_id=0, limit=None):
+        # type: (int, int | None) -> Generator[Story, None, None]
+        """
+        Yield all Stories in story id order,
+        starting after story id `after_id` (a keyset cursor) and yielding at most `limit`.
+        """
+        story = self.identity_map.story
+        for story_id, storyname in self.db.cursor.execute(
+                'SELECT id, storyname FROM stories WHERE id > ? ORDER BY id LIMIT ?',
+                [after_id, -1 if limit is None else limit]):
+            yield story(story_id, storyname)
 
     def verify_story(self, story):
         # type: (Story) -> bool
@@ -196,54 +726,208 @@ class StoryTellingDatabase(object):
                                [story.id, story.storyname])
         return self.db.result_exists()
 
-    _EDITED_STORIES_SQL = '''
-        SELECT stories.id, storyname FROM edits, stories, users 
-            WHERE user_id = users.id 
-            AND story_id = stories.id 
-            AND users.id = ?'''
-
-    def get_edited_stories(self, user):
-        # type: (User) -> Generator[Story, None, None]
+    def get_edited_stories(self, user, after_id=0, limit=None):
+        # type: (User, int, int | None) -> Generator[Story, None, None]
+        """
+        Yield Stories the given User has edited in story id order,
+        starting after story id `after_id` (a keyset cursor) and yielding at most `limit`.
+        """
+        story = self.identity_map.story
         for story_id, storyname in self.db.cursor.execute(
-                self._EDITED_STORIES_SQL, [user.id]):
-            yield Story(story_id, storyname)
-
-    def get_unedited_stories(self, user):
-        # type: (User) -> Generator[Story, None, None]
+                '''
+                SELECT stories.id, storyname FROM edits, stories
+                    WHERE story_id = stories.id
+                        AND user_id = ?
+                        AND story_id > ?
+                    ORDER BY story_id
+                    LIMIT ?
+                ''', [user.id, after_id, -1 if limit is None else limit]):
+            yield story(story_id, storyname)
+
+    def get_unedited_stories(self, user, after_id=0, limit=None):
+        # type: (User, int, int | None) -> Generator[Story, None, None]
+        """
+        Yield Stories the given User hasn't edited in story id order,
+        starting after story id `after_id` (a keyset cursor) and yielding at most `limit`.
+        """
+        story = self.identity_map.story
         for story_id, storyname in self.db.cursor.execute(
-                        'SELECT id, storyname FROM stories EXCEPT' + self._EDITED_STORIES_SQL,
-                [user.id]):
-            yield Story(story_id, storyname)
+                '''
+                SELECT id, storyname FROM stories
+                    WHERE id > ?
+                        AND NOT EXISTS (
+                            SELECT 1 FROM edits WHERE story_id = stories.id AND user_id = ?)
+                    ORDER BY id
+                    LIMIT ?
+                ''', [after_id, user.id, -1 if limit is None else limit]):
+            yield story(story_id, storyname)
 
     def get_edits(self, story):
         # type: (Story) -> Generator[Edit, None, None]
         """Yield all Edits of a given Story."""
-        for user_id, username, text, time in self.db.cursor.execute(
-                'SELECT users.id, username, text, time '
-                'FROM edits, users, stories '
+        edit = self.identity_map.edit
+        for edit_id, user_id, username, text, time in self.db.cursor.execute(
+                'SELECT edits.id, users.id, username, text, ifnull(time_us, time) '
+                'FROM edits, users '
                 'WHERE user_id = users.id '
-                'AND story_id = stories.id '
-                'AND stories.id = ?'
-                'ORDER BY edits.ROWID',
+                'AND story_id = ? '
+                'ORDER BY edits.id',
                 [story.id]):
-            time = dateutil.parser.parse(time)
-            yield Edit(story, User(user_id, username), text, time)
+            yield edit(edit_id, story, user_id, username, text, time)
+
+    @staticmethod
+    def _search_query(query):
+        # type: (unicode) -> unicode
+        """Turn user input into an FTS5 query matching all its words, ignoring FTS5 syntax."""
+        return u' '.join(u'"{}"'.format(word) for word in re.findall(r'\w+', query, re.UNICODE))
+
+    def search(self, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        # type: (unicode, int, int) -> List[Story]
+        """
+        Search storynames and edit text for all the words in `query`.
+        Return Stories ranked by their best match (matching storynames rank higher),
+        skipping the first `offset` and returning at most `limit`.
+
+        If the search index doesn't exist, raise StoryTellingException.
+        """
+        if not self.db.table_exists('edits_search'):
+            raise StoryTellingException('search is not available')
+        match = self._search_query(query)
+        if not match:
+            return []
+        sql = '''
+        SELECT stories.id, storyname FROM (
+                SELECT rowid AS story_id, 2 * bm25(stories_search) AS rank
+                    FROM stories_search WHERE stories_search MATCH :match
+                UNION ALL
+                SELECT story_id, bm25(edits_search) AS rank
+                    FROM edits_search, edits
+                    WHERE edits_search MATCH :match AND edits.id = edits_search.rowid
+            ) AS matches, stories
+            WHERE stories.id = matches.story_id
+            GROUP BY stories.id
+            ORDER BY min(rank), stories.id
+            LIMIT :limit OFFSET :offset
+        '''
+        self.db.cursor.execute(sql, dict(match=match, limit=limit, offset=offset))
+        story = self.identity_map.story
+        return [story(story_id, storyname) for story_id, storyname in self.db.cursor]
+
+    def rebuild_search_index(self):
+        # type: () -> None
+        """Rebuild the search index, e.g. after a bulk import with its triggers suspended."""
+        with self.db.writing():
+            rebuild_search_index(self.db)
+            self.commit()
+
+    def get_edit_page(self, story, after_rowid=0, limit=EDIT_PAGE_SIZE):
+        # type: (Story, int, int) -> Tuple[List[Edit], int]
+        """
+        Get up to `limit` Edits of a given Story in order,
+        starting after edit id `after_rowid` (a keyset cursor).
+        Return the Edits and the cursor of the next page.
+        """
+        rows = self.db.cursor.execute(
+            'SELECT edits.id, users.id, username, text, ifnull(time_us, time) '
+            'FROM edits, users '
+            'WHERE user_id = users.id '
+            'AND story_id = ? '
+            'AND edits.id > ? '
+            'ORDER BY edits.id '
+            'LIMIT ?',
+            [story.id, after_rowid, limit]).fetchall()
+        edit = self.identity_map.edit
+        edits = [edit(edit_id, story, user_id, username, text, time)
+                 for edit_id, user_id, username, text, time in rows]
+        return edits, rows[-1][0] if rows else after_rowid
+
+    def iter_edits(self, story, page_size=EDIT_PAGE_SIZE):
+        # type: (Story, int) -> Generator[Edit, None, None]
+        """
+        Yield all Edits of a given Story, fetching `page_size` at a time.
+
+        Each page checks out its own pooled connection (see `lock()`),
+        so this can be consumed lazily, e.g. while streaming a response,
+        and only one page is ever held in memory.
+        """
+        after_rowid = 0
+        while True:
+            with self:
+                edits, after_rowid = self.get_edit_page(story, after_rowid, page_size)
+            for edit in edits:
+                yield edit
+            if len(edits) < page_size:
+                return
 
     def get_last_edit(self, story):
         # type: (Story) -> Edit
+        return self.last_edit_cache.get(story.id, lambda: self._get_last_edit(story))
+
+    def _get_last_edit(self, story):
+        # type: (Story) -> Edit
+        sql = '''
+        SELECT edits.id, users.id, username, text, ifnull(time_us, time)
+            FROM story_summary, edits, users
+            WHERE story_summary.story_id = ?
+                AND edits.id = last_edit_rowid
+                AND users.id = last_editor_id
+        '''
+        self.db.cursor.execute(sql, [story.id])
+        edit_id, user_id, username, text, time = self.db.cursor.fetchone()
+        return self.identity_map.edit(edit_id, story, user_id, username, text, time)
+
+    def get_story_version(self, story):
+        # type: (Story) -> Tuple[int, datetime]
+        """Get the id and time of the last Edit of a Story, which change whenever it's edited."""
         sql = '''
-        SELECT users.id, username, text, time FROM edits, users
-            WHERE edits.ROWID = (
-                SELECT max(edits.ROWID) FROM edits, users, stories 
-                    WHERE user_id = users.id 
-                        AND story_id = stories.id 
-                        AND stories.id = ?
-            )
+        SELECT last_edit_rowid, ifnull(time_us, time) FROM story_summary, edits
+            WHERE story_summary.story_id = ?
+                AND edits.id = last_edit_rowid
         '''
         self.db.cursor.execute(sql, [story.id])
-        user_id, username, text, time = self.db.cursor.fetchone()
-        time = dateutil.parser.parse(time)
-        return Edit(story, User(user_id, username), text, time)
+        rowid, time = self.db.cursor.fetchone()
+        return rowid, decode_time(time)
+
+    def get_version(self):
+        # type: () -> Tuple[int, datetime | None]
+        """
+        Get the id and time of the last Edit of any Story,
+        which change whenever a Story is created or edited, or (0, None) if there are none.
+        """
+        self.db.cursor.execute(
+            'SELECT id, ifnull(time_us, time) FROM edits ORDER BY id DESC LIMIT 1')
+        row = self.db.cursor.fetchone()
+        if row is None:
+            return 0, None
+        rowid, time = row
+        return rowid, decode_time(time)
+
+    _SUMMARIES_CHUNK_SIZE = 500
+
+    def get_summaries(self, stories):
+        # type: (Iterable[Story]) -> Dict[int, StorySummary]
+        """Get the StorySummary of each given Story that has been edited, keyed by story id."""
+        stories = {story.id: story for story in stories}
+        story_ids = list(stories)
+        summaries = {}  # type: Dict[int, StorySummary]
+        for i in xrange(0, len(story_ids), self._SUMMARIES_CHUNK_SIZE):
+            chunk = story_ids[i:i + self._SUMMARIES_CHUNK_SIZE]
+            sql = '''
+            SELECT story_id, edit_count, last_edit_time_us, users.id, username
+                FROM story_summary, users
+                WHERE users.id = last_editor_id
+                    AND story_id IN ({})
+            '''.format(', '.join('?' * len(chunk)))
+            for story_id, edit_count, time, user_id, username in self.db.cursor.execute(
+                    sql, chunk):
+                summaries[story_id] = StorySummary(stories[story_id], edit_count, decode_time(time),
+                                                   self.identity_map.user(user_id, username))
+        return summaries
+
+    def get_summary(self, story):
+        # type: (Story) -> StorySummary | None
+        """Get the StorySummary of given Story, or None if it has no edits."""
+        return self.get_summaries([story]).get(story.id)
 
     def get_editors(self, story):
         # type: (Story) -> Generator[User, None, None]
@@ -254,10 +938,10 @@ class StoryTellingDatabase(object):
     def _get_start_time(self, table, user_or_story):
         # type: (User | Story) -> datetime
         # should use some sort of table inheritance if such a thing exists
-        self.db.cursor.execute('SELECT start_time FROM {} WHERE id = ?'.format(table),
-                               [user_or_story.id])
-        time = self.db.cursor.fetchone()[0]
-        return dateutil.parser.parse(time)
+        self.db.cursor.execute(
+            'SELECT ifnull(start_time_us, start_time) FROM {} WHERE id = ?'.format(table),
+            [user_or_story.id])
+        return decode_time(self.db.cursor.fetchone()[0])
 
     def get_user_start_time(self, user):
         # type: (User) -> datetime
@@ -273,23 +957,66 @@ class StoryTellingDatabase(object):
         # type: (Story, User) -> bool
         """Check if given User can edit given Story,
         i.e. the User hasn't edited the given Story yet."""
-        for other_user in self.get_editors(story):
-            if user.id == other_user.id:
-                return False
-        return True
+        return self.can_edit_cache.get((story.id, user.id), lambda: self._can_edit(story, user))
+
+    def _can_edit(self, story, user):
+        # type: (Story, User) -> bool
+        """Uncached can_edit, a lookup of the unique (story_id, user_id) key."""
+        self.db.cursor.execute('SELECT 1 FROM edits WHERE story_id = ? AND user_id = ?',
+                               [story.id, user.id])
+        return not self.db.result_exists()
+
+    def _write(self, write):
+        # type: (Callable[[], T]) -> T
+        """
+        Run `write`, which writes through `self.db.cursor`, in a transaction
+        and return its result once committed.
+
+        With group commit on, concurrent writes share transactions (see `GroupCommitter`).
+        Once committed, the cache invalidations of the write are run again.
+        """
 
-    def _add_user_hard_only(self, username, password):
+        def collecting_write():
+            self._write_local.invalidations = invalidations = []
+            try:
+                return write(), invalidations
+            finally:
+                self._write_local.invalidations = None
+
+        if self.group_committer is not None:
+            result, invalidations = self.group_committer.submit(collecting_write)
+        else:
+            with self.db.writing():
+                try:
+                    result, invalidations = collecting_write()
+                except Exception:
+                    self.db.conn.rollback()
+                    raise
+                self.commit()
+        for invalidate in invalidations:
+            invalidate()
+        return result
+
+    def _invalidate(self, cache, key):
+        # type: (LRUCache, object) -> None
+        """Invalidate a cache entry now and, if in a `_write`, again once it commits."""
+        cache.invalidate(key)
+        invalidations = getattr(self._write_local, 'invalidations', None)
+        if invalidations is not None:
+            invalidations.append(lambda: cache.invalidate(key))
+
+    def _add_user_hard_only(self, username, hashed_password):
         # type: (unicode, unicode) -> None
-        hashed_password = hash_password(password)
-        self.db.cursor.execute('INSERT INTO users VALUES (NULL, ?, ?, ?)',
-                               [username, hashed_password, datetime.now().isoformat()])
+        time = datetime.now()
+        self.db.cursor.execute(
+            'INSERT INTO users (username, password, start_time, start_time_us) '
+            'VALUES (?, ?, ?, ?)',
+            [username, hashed_password, time.isoformat(), encode_time(time)])
 
-    def _add_user_hard(self, username, password):
+    def _add_user_hard(self, username, hashed_password):
         # type: (unicode, unicode) -> User
-        self._add_user_hard_only(username, password)
-        user_id = self.db.cursor.lastrowid
-        self.commit()
-        return User(user_id, username)
+        self._add_user_hard_only(username, hashed_password)
+        return User(self.db.cursor.lastrowid, username)
 
     def add_user(self, username, password):
         # type: (unicode, unicode) -> User
@@ -298,18 +1025,32 @@ class StoryTellingDatabase(object):
 
         If User with given username already exists,
         raise a StoryTellingException.
+
+        The password is hashed outside of any lock, before the write is queued.
         """
-        if self.user_exists(username):
-            raise StoryTellingException('username "{}" already exists'.format(username))
-        return self._add_user_hard(username, password)
+
+        def check_username():
+            if self.user_exists(username):
+                raise StoryTellingException('username "{}" already exists'.format(username))
+
+        with self:
+            check_username()  # fail before hashing if possible
+        hashed_password = self.password_workers.hash(password)
+
+        def write():
+            check_username()
+            return self._add_user_hard(username, hashed_password)
+
+        return self._write(write)
 
     def _create_story_hard(self, storyname):
         # type: (unicode) -> Story
-        self.db.cursor.execute('INSERT INTO stories VALUES (NULL, ?, ?)',
-                               [storyname, datetime.now().isoformat()])
-        story_id = self.db.cursor.lastrowid
-        self.commit()
-        return Story(story_id, storyname)
+        time = datetime.now()
+        self.db.cursor.execute(
+            'INSERT INTO stories (storyname, start_time, start_time_us) VALUES (?, ?, ?)',
+            [storyname, time.isoformat(), encode_time(time)])
+        self._invalidate(self.story_cache, storyname)
+        return Story(self.db.cursor.lastrowid, storyname)
 
     def _add_story_hard(self, storyname, user, text):
         # type: (unicode, User, unicode) -> Tuple[Story, Edit]
@@ -332,16 +1073,32 @@ class StoryTellingDatabase(object):
         :return: the Story created and the first Edit
         :rtype: Tuple[Story, Edit]
         """
+        return self._write(lambda: self._add_new_story_hard(storyname, user, text))
+
+    def _add_new_story_hard(self, storyname, user, text):
+        # type: (unicode, User, unicode) -> Tuple[Story, Edit]
+        """`_add_story_hard`, raising a StoryTellingException if the storyname is taken."""
         if self.story_exists(storyname):
             raise StoryTellingException('story "{}" already exists'.format(storyname))
         return self._add_story_hard(storyname, user, text)
 
     def _edit_story_hard(self, story, user, text):
         # type: (Story, User, unicode) -> Edit
+        """
+        Insert an Edit, relying on the unique (story_id, user_id) key
+        to raise a StoryTellingException if the User already edited the Story.
+        """
         time = datetime.now()
-        self.db.cursor.execute('INSERT INTO edits VALUES (?, ?, ?, ?)',
-                               [story.id, user.id, text, time.isoformat()])
-        self.commit()
+        try:
+            self.db.cursor.execute(
+                'INSERT INTO edits (story_id, user_id, text, time, time_us) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [story.id, user.id, text, time.isoformat(), encode_time(time)])
+        except sqlite3.IntegrityError:
+            self._invalidate(self.can_edit_cache, (story.id, user.id))
+            raise StoryTellingException('already edited this story ({})'.format(story.storyname))
+        self._invalidate(self.last_edit_cache, story.id)
+        self._invalidate(self.can_edit_cache, (story.id, user.id))
         return Edit(story, user, text, time)
 
     def edit_story(self, story, user, text):
@@ -352,10 +1109,9 @@ class StoryTellingDatabase(object):
 
         If the User cannot edit the Story (see #can_edit(Story, User)),
         raise a StoryTellingException.
+        This is detected by the insert itself, so concurrent edits can't both succeed.
         """
-        if not self.can_edit(story, user):
-            raise StoryTellingException('already edited this story ({})'.format(story.storyname))
-        return self._edit_story_hard(story, user, text)
+        return self._write(lambda: self._edit_story_hard(story, user, text))
 
 
 def main():
@@ -0,0 +1,236 @@
+"""
+Compact binary encoding of session and cache values,
+including namedtuples given a tag by `util.namedtuple_factory.namedtuple`,
+like User, Story and Edit.
+
+Each value is a one-byte type tag followed by its struct-packed payload.
+Tagged namedtuples take one byte (NAMEDTUPLE + their tag)
+followed by their fields in order, without any field names.
+Like `json` and `pickle`, this module is itself a serializer with `dumps()` and `loads()`.
+"""
+
+import struct
+from datetime import datetime, timedelta
+
+from typing import Any, Callable, Dict, List, Tuple
+
+from util.namedtuple_factory import tagged_namedtuples
+
+"""Type tags."""
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT32 = 3
+INT64 = 4
+FLOAT = 5
+UNICODE = 6
+BYTES = 7
+TUPLE = 8
+LIST = 9
+DICT = 10
+DATETIME = 11
+NAMEDTUPLE = 32  # + the namedtuple's tag
+
+_TAG = struct.Struct('<B')
+_INT32 = struct.Struct('<Bi')
+_INT64 = struct.Struct('<Bq')
+_FLOAT = struct.Struct('<Bd')
+_SIZED = struct.Struct('<BI')  # strings, by length, and containers, by number of items
+_INT32_VALUE = struct.Struct('<i')
+_INT64_VALUE = struct.Struct('<q')
+_FLOAT_VALUE = struct.Struct('<d')
+_SIZE = struct.Struct('<I')
+
+_EPOCH = datetime(1970, 1, 1)
+_MIN_INT32 = -(1 << 31)
+_MAX_INT32 = (1 << 31) - 1
+
+Chunks = List[str]
+
+
+def _encode_int(value, out):
+    # type: (int, Chunks) -> None
+    if _MIN_INT32 <= value <= _MAX_INT32:
+        out.append(_INT32.pack(INT32, value))
+    else:
+        out.append(_INT64.pack(INT64, value))
+
+
+def _encode_unicode(value, out):
+    # type: (unicode, Chunks) -> None
+    encoded = value.encode('utf-8')
+    out.append(_SIZED.pack(UNICODE, len(encoded)))
+    out.append(encoded)
+
+
+def _encode_bytes(value, out):
+    # type: (str, Chunks) -> None
+    out.append(_SIZED.pack(BYTES, len(value)))
+    out.append(value)
+
+
+def _encoder_of_items(tag):
+    # type: (int) -> Callable[[Any, Chunks], None]
+    def encode_items(value, out):
+        out.append(_SIZED.pack(tag, len(value)))
+        for item in value:
+            _encode(item, out)
+
+    return encode_items
+
+
+def _encode_dict(value, out):
+    # type: (Dict, Chunks) -> None
+    out.append(_SIZED.pack(DICT, len(value)))
+    for key, item in value.iteritems():
+        _encode(key, out)
+        _encode(item, out)
+
+
+def _encode_datetime(value, out):
+    # type: (datetime, Chunks) -> None
+    if value.tzinfo is not None:
+        raise TypeError('cannot encode timezone-aware datetime {!r}'.format(value))
+    delta = value - _EPOCH
+    out.append(_INT64.pack(DATETIME, (delta.days * 86400 + delta.seconds) * 1000000
+                           + delta.microseconds))
+
+
+_ENCODERS = {
+    type(None): lambda value, out: out.append(_TAG.pack(NONE)),
+    bool: lambda value, out: out.append(_TAG.pack(TRUE if value else FALSE)),
+    int: _encode_int,
+    long: _encode_int,
+    float: lambda value, out: out.append(_FLOAT.pack(FLOAT, value)),
+    unicode: _encode_unicode,
+    str: _encode_bytes,
+    tuple: _encoder_of_items(TUPLE),
+    list: _encoder_of_items(LIST),
+    dict: _encode_dict,
+    datetime: _encode_datetime,
+}  # type: Dict[type, Callable[[Any, Chunks], None]]
+
+"""Base types, in the order subclasses of them are checked."""
+_BASE_TYPES = (bool, int, long, float, unicode, str, tuple, list, dict, datetime)
+
+
+def _encode(value, out):
+    # type: (Any, Chunks) -> None
+    value_type = type(value)
+    encoder = _ENCODERS.get(value_type)
+    if encoder is not None:
+        encoder(value, out)
+        return
+    tag = getattr(value_type, '_tag', None)
+    if tag is not None and tagged_namedtuples.get(tag) is value_type:
+        out.append(_TAG.pack(NAMEDTUPLE + tag))
+        for field in value:
+            _encode(field, out)
+        return
+    for base_type in _BASE_TYPES:
+        if isinstance(value, base_type):
+            # e.g. Markup or a session dict, encoded as their base type
+            _ENCODERS[base_type](value, out)
+            return
+    raise TypeError('cannot encode {!r}'.format(value))
+
+
+def dumps(value):
+    # type: (Any) -> str
+    """Encode a value."""
+    out = []  # type: Chunks
+    _encode(value, out)
+    return ''.join(out)
+
+
+def _decode_sized(data, offset):
+    # type: (str, int) -> Tuple[int, int]
+    return _SIZE.unpack_from(data, offset)[0], offset + _SIZE.size
+
+
+def _decode_unicode(data, offset):
+    size, offset = _decode_sized(data, offset)
+    end = offset + size
+    return data[offset:end].decode('utf-8'), end
+
+
+def _decode_bytes(data, offset):
+    size, offset = _decode_sized(data, offset)
+    end = offset + size
+    return data[offset:end], end
+
+
+def _decode_items(data, offset):
+    # type: (str, int) -> Tuple[List, int]
+    size, offset = _decode_sized(data, offset)
+    items = []
+    for _ in xrange(size):
+        item, offset = _decode(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _decode_tuple(data, offset):
+    items, offset = _decode_items(data, offset)
+    return tuple(items), offset
+
+
+def _decode_dict(data, offset):
+    size, offset = _decode_sized(data, offset)
+    value = {}
+    for _ in xrange(size):
+        key, offset = _decode(data, offset)
+        value[key], offset = _decode(data, offset)
+    return value, offset
+
+
+def _decode_struct(value_struct, convert=None):
+    def decode(data, offset):
+        value = value_struct.unpack_from(data, offset)[0]
+        if convert is not None:
+            value = convert(value)
+        return value, offset + value_struct.size
+
+    return decode
+
+
+_DECODERS = {
+    NONE: lambda data, offset: (None, offset),
+    FALSE: lambda data, offset: (False, offset),
+    TRUE: lambda data, offset: (True, offset),
+    INT32: _decode_struct(_INT32_VALUE),
+    INT64: _decode_struct(_INT64_VALUE),
+    FLOAT: _decode_struct(_FLOAT_VALUE),
+    UNICODE: _decode_unicode,
+    BYTES: _decode_bytes,
+    TUPLE: _decode_tuple,
+    LIST: _decode_items,
+    DICT: _decode_dict,
+    DATETIME: _decode_struct(_INT64_VALUE, lambda us: _EPOCH + timedelta(microseconds=us)),
+}
+
+
+def _decode(data, offset):
+    # type: (str, int) -> Tuple[Any, int]
+    tag = ord(data[offset])
+    offset += 1
+    decoder = _DECODERS.get(tag)
+    if decoder is not None:
+        return decoder(data, offset)
+    namedtuple_type = tagged_namedtuples.get(tag - NAMEDTUPLE)
+    if namedtuple_type is None:
+        raise ValueError('unknown type tag {} at {}'.format(tag, offset - 1))
+    fields = []
+    for _ in xrange(len(namedtuple_type._fields)):
+        field, offset = _decode(data, offset)
+        fields.append(field)
+    return namedtuple_type._make(fields), offset
+
+
+def loads(data):
+    # type: (str) -> Any
+    """Decode a value encoded by `dumps()`."""
+    value, offset = _decode(data, 0)
+    if offset != len(data):
+        raise ValueError('{} trailing bytes'.format(len(data) - offset))
+    return value
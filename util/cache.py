@@ -0,0 +1,166 @@
+"""Bounded, thread-safe LRU caches, by number of entries or by their size in bytes."""
+
+import threading
+from collections import OrderedDict
+from time import time
+
+from typing import Any, Callable, Dict, Hashable, TypeVar
+
+from util.metrics import Counter
+
+T = TypeVar('T')
+
+CACHE_LOOKUPS = Counter('storytelling_cache_lookups_total',
+                        'Cache lookups by cache and result (hit or miss)', ['cache', 'result'])
+
+
+class LRUCache(object):
+    """
+    Cache of at most `max_size` entries, evicting the least recently used.
+    With `max_size` 0, nothing is cached.
+    With `ttl`, entries expire `ttl` seconds after they're loaded,
+    bounding how stale they get when the source changes without invalidating them.
+
+    A value loaded while the cache was invalidated isn't cached,
+    since it may have been read before the write causing the invalidation.
+    Lookups are counted in CACHE_LOOKUPS under `name`.
+    """
+
+    def __init__(self, name, max_size, ttl=None):
+        # type: (str, int, float | None) -> None
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict  # key -> (value, expiry time or None)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hit_counter = CACHE_LOOKUPS.labels(name, 'hit')
+        self._miss_counter = CACHE_LOOKUPS.labels(name, 'miss')
+
+    def get(self, key, load):
+        # type: (Hashable, Callable[[], T]) -> T
+        """Get the cached value of `key`, or load, cache and return it."""
+        now = time() if self.ttl is not None else None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (now is None or entry[1] > now):
+                self._entries[key] = entry  # now the most recently used
+                value = entry[0]
+                self.hits += 1
+                hit = True
+            else:
+                self.misses += 1
+                generation = self._generation
+                hit = False
+        if hit:
+            self._hit_counter.inc()
+            return value
+        self._miss_counter.inc()
+        value = load()
+        with self._lock:
+            if generation == self._generation and self.max_size:
+                self._entries[key] = value, None if now is None else now + self.ttl
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        # type: (Hashable) -> None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                size=len(self._entries),
+                max_size=self.max_size,
+                ttl=self.ttl,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                hit_rate=float(self.hits) / lookups if lookups else 0.0,
+            )
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SizedLRUCache(object):
+    """
+    Cache of entries totalling at most `max_bytes`, evicting the least recently used.
+    The size of each entry is given when it's put.
+    Entries larger than `max_bytes` aren't cached.
+    """
+
+    def __init__(self, name, max_bytes):
+        # type: (str, int) -> None
+        self.name = name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # type: OrderedDict  # key -> (value, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # type: (Hashable) -> Any
+        """Get the cached value of `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry  # now the most recently used
+            return entry[0]
+
+    def put(self, key, value, size):
+        # type: (Hashable, Any, int) -> None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value, size
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        # type: (Hashable) -> None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                bytes=self.bytes,
+                max_bytes=self.max_bytes,
+                evictions=self.evictions,
+            )
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,19 +1,312 @@
+from __future__ import print_function
+
 import sqlite3
 import threading
+from collections import deque, namedtuple
+from functools import partial
+from Queue import Queue, Empty
+from contextlib import contextmanager
+from sys import stderr
+from time import time
+
+from typing import Any, Callable, Dict, Iterable, List, TypeVar
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_GROUP_COMMIT_INTERVAL = 0.002  # seconds
+DEFAULT_GROUP_COMMIT_SIZE = 256
+SLOW_QUERY_LOG_SIZE = 100
+"""Number of most recent slow queries kept in `Database.slow_queries`."""
+
+T = TypeVar('T')
+
+
+class ConnectionPool(object):
+    """
+    Checkout/checkin pool of at most `size` connections to the same database.
+
+    Connections are created lazily and reused.
+    Time spent waiting for a free connection is recorded.
+    """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE):
+        # type: (Callable[[], sqlite3.Connection], int) -> None
+        self._connect = connect
+        self.size = size
+        self._idle = Queue()  # type: Queue
+        self._slots = threading.BoundedSemaphore(size)
+        self._stats_lock = threading.Lock()
+        self._connections = []  # type: List[sqlite3.Connection]
+        self.num_checkouts = 0
+        self.num_waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def checkout(self):
+        # type: () -> sqlite3.Connection
+        """Check out an idle connection, waiting if all `size` connections are in use."""
+        waited = 0.0
+        if not self._slots.acquire(False):
+            start = time()
+            self._slots.acquire()
+            waited = time() - start
+        with self._stats_lock:
+            self.num_checkouts += 1
+            if waited > 0:
+                self.num_waits += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            conn = self._connect()
+            with self._stats_lock:
+                self._connections.append(conn)
+            return conn
+
+    def checkin(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Return a checked out connection, discarding any uncommitted changes."""
+        with self._stats_lock:
+            pooled = conn in self._connections
+        if pooled:
+            conn.rollback()
+            self._idle.put(conn)
+        else:
+            conn.close()  # pool was closed while conn was checked out
+        self._slots.release()
+
+    def close(self):
+        # type: () -> None
+        """Close all connections, idle or not."""
+        with self._stats_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._idle = Queue()
+
+    def stats(self):
+        # type: () -> Dict[str, float]
+        with self._stats_lock:
+            return dict(
+                size=self.size,
+                connections=len(self._connections),
+                checkouts=self.num_checkouts,
+                waits=self.num_waits,
+                wait_time=self.wait_time,
+                max_wait_time=self.max_wait_time,
+            )
+
+
+class QueryStats(object):
+    """Number, total time and max time of executed statements."""
+
+    __slots__ = ('count', 'time', 'max_time')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.max_time = 0.0
+
+    def add(self, elapsed):
+        # type: (float) -> None
+        self.count += 1
+        self.time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def as_dict(self):
+        # type: () -> Dict[str, float]
+        return dict(count=self.count, time=self.time, max_time=self.max_time)
+
+
+SlowQuery = namedtuple('SlowQuery', ['sql', 'parameters', 'time', 'plan'])
+
+
+class _InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor timing the statements it executes and recording them in its `Database`.
+
+    For SELECTs, only the time to the first row is measured,
+    since the rest are stepped through as they're fetched.
+    """
+
+    def __init__(self, conn, database):
+        # type: (sqlite3.Connection, Database) -> None
+        super(_InstrumentedCursor, self).__init__(conn)
+        self._database = database
+
+    def execute(self, sql, parameters=()):
+        start = time()
+        try:
+            return super(_InstrumentedCursor, self).execute(sql, parameters)
+        finally:
+            self._database._record_query(self.connection, sql, parameters, time() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time()
+        try:
+            return super(_InstrumentedCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            self._database._record_query(self.connection, sql, None, time() - start)
+
+
+class _ThreadState(threading.local):
+    """Connection and cursor checked out by the current thread."""
+
+    def __init__(self):
+        self.depth = 0
+        self.write_depth = 0
+        self.conn = None  # type: sqlite3.Connection
+        self.cursor = None  # type: sqlite3.Cursor
+        self.query_stats = None  # type: QueryStats
 
 
 class Database(object):
-    """Database wrapper."""
+    """
+    Database wrapper.
+
+    Inside `with db:`, each thread uses its own read-only connection checked out from `pool`,
+    so reads from different threads run in parallel.
+    Writes go through `with db.writing():`, which serializes them
+    on the single writer connection.
+    Outside of both, only a thread holding the write lock (`lock_writes()`)
+    may use the writer connection directly, e.g. a single-threaded bulk writer;
+    any other use of `conn` or `cursor` raises a RuntimeError
+    rather than racing with the threads writing through it.
 
-    def __init__(self, path, debug=False):
-        # type: (str) -> None
+    With `wal=True`, the database is put in WAL mode so readers never wait on the writer.
+    `mmap_size` (bytes) and `cache_size` (pages, or KiB if negative)
+    are applied to every connection if given.
+
+    Statements executed through `cursor` are timed and counted,
+    in total (`num_queries`), per SQL statement (`statement_stats()`)
+    and per thread between `start_tracking()` and `stop_tracking()`.
+    Statements taking at least `slow_query_threshold` seconds are logged
+    with their query plans and kept in `slow_queries`.
+    """
+
+    def __init__(self, path, debug=False, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 wal=False, mmap_size=None, cache_size=None, slow_query_threshold=None):
+        # type: (str, bool, int, float, bool, int | None, int | None, float | None) -> None
         self.path = path
-        self.conn = sqlite3.connect(path, check_same_thread=False)
-        # mulithreading is only safe when Database.lock() is used
-        self.cursor = self.conn.cursor()
-        self._lock = threading.RLock()
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self._conn = self._connect()
+        if wal:
+            self._conn.execute('PRAGMA journal_mode = WAL')
+        self._query_stats_lock = threading.Lock()
+        self.num_queries = 0
+        self._statement_stats = {}  # type: Dict[str, QueryStats]
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)  # type: deque
+        self._cursor = self.new_cursor(self._conn)
+        self.pool = ConnectionPool(partial(self._connect, read_only=True), pool_size)
+        self._local = _ThreadState()
+        self._write_lock = threading.RLock()
+        self._write_stats_lock = threading.Lock()
+        self.num_write_waits = 0
+        self.write_wait_time = 0.0
+        self.num_commits = 0
         self.debug = debug
 
+    def _connect(self, read_only=False):
+        # type: (bool) -> sqlite3.Connection
+        # mulithreading is only safe when Database.lock() or Database.writing() is used
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        if self.mmap_size is not None:
+            conn.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        if self.cache_size is not None:
+            conn.execute('PRAGMA cache_size = {:d}'.format(self.cache_size))
+        if read_only:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def new_cursor(self, conn):
+        # type: (sqlite3.Connection) -> sqlite3.Cursor
+        """Cursor on `conn` whose statements are timed and counted."""
+        return conn.cursor(partial(_InstrumentedCursor, database=self))
+
+    def _record_query(self, conn, sql, parameters, elapsed):
+        # type: (sqlite3.Connection, str, Iterable | None, float) -> None
+        """
+        Record a statement taking `elapsed` seconds,
+        with `parameters` None for `executemany()`.
+        """
+        with self._query_stats_lock:
+            self.num_queries += 1
+            stats = self._statement_stats.get(sql)
+            if stats is None:
+                stats = self._statement_stats[sql] = QueryStats()
+            stats.add(elapsed)
+        tracked = self._local.query_stats
+        if tracked is not None:
+            tracked.add(elapsed)
+        threshold = self.slow_query_threshold
+        if threshold is not None and elapsed >= threshold:
+            self._log_slow_query(conn, sql, parameters, elapsed)
+
+    def _log_slow_query(self, conn, sql, parameters, elapsed):
+        # type: (sqlite3.Connection, str, Iterable | None, float) -> None
+        plan = []  # type: List[str]
+        if parameters is not None:
+            try:
+                # through the connection, so the plan isn't recorded as a query itself
+                plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+            except sqlite3.Error:
+                pass  # not explainable, like PRAGMAs
+        slow_query = SlowQuery(sql, parameters, elapsed, plan)
+        self.slow_queries.append(slow_query)
+        print('slow query ({:.1f} ms): {}'.format(elapsed * 1000, ' '.join(sql.split())),
+              file=stderr)
+        for detail in plan:
+            print('    ' + detail, file=stderr)
+
+    def statement_stats(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        """Stats of each distinct SQL statement executed."""
+        with self._query_stats_lock:
+            return {sql: stats.as_dict() for sql, stats in self._statement_stats.viewitems()}
+
+    def start_tracking(self):
+        # type: () -> QueryStats
+        """Start collecting the stats of this thread's statements (and the writes it submits)."""
+        stats = self._local.query_stats = QueryStats()
+        return stats
+
+    def stop_tracking(self):
+        # type: () -> QueryStats | None
+        """Stop collecting this thread's stats, returning them (None if not tracking)."""
+        stats = self._local.query_stats
+        self._local.query_stats = None
+        return stats
+
+    @property
+    def conn(self):
+        # type: () -> sqlite3.Connection
+        """Connection of the current thread."""
+        conn = self._local.conn
+        if conn is None:
+            self._check_owns_writer()
+            return self._conn
+        return conn
+
+    @property
+    def cursor(self):
+        # type: () -> sqlite3.Cursor
+        """Cursor of the current thread."""
+        cursor = self._local.cursor
+        if cursor is None:
+            self._check_owns_writer()
+            return self._cursor
+        return cursor
+
+    def _check_owns_writer(self):
+        # type: () -> None
+        if not self.owns_write_lock():
+            raise RuntimeError('use the database inside `with db:` or `db.writing()`')
+
     @staticmethod
     def sanitize(s):
         # type: (str) -> str
@@ -34,11 +327,19 @@ class Database(object):
 
     def commit(self):
         # type: () -> None
+        """Commit the current thread's connection, or the writer connection outside of any."""
+        if self._local.conn is None and not self.owns_write_lock():
+            with self.writing():
+                self.commit()
+            return
         self.conn.commit()
+        with self._write_stats_lock:
+            self.num_commits += 1
 
     def hard_close(self):
         # type: () -> None
-        self.conn.close()
+        self.pool.close()
+        self._conn.close()
 
     def close(self):
         # type: () -> None
@@ -47,11 +348,91 @@ class Database(object):
 
     def lock(self):
         # type: () -> None
-        self._lock.acquire()
+        """Check out a pooled connection for this thread (reentrant)."""
+        local = self._local
+        if local.depth == 0:
+            local.conn = self.pool.checkout()
+            local.cursor = self.new_cursor(local.conn)
+        local.depth += 1
 
     def release_lock(self):
         # type: () -> None
-        self._lock.release()
+        """Check the pooled connection back in once the outermost lock is released."""
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            conn = local.conn
+            local.conn = None
+            local.cursor = None
+            self.pool.checkin(conn)
+
+    def lock_writes(self):
+        # type: () -> None
+        if not self._write_lock.acquire(False):
+            start = time()
+            self._write_lock.acquire()
+            waited = time() - start
+            with self._write_stats_lock:
+                self.num_write_waits += 1
+                self.write_wait_time += waited
+        self._local.write_depth += 1
+
+    def release_write_lock(self):
+        # type: () -> None
+        self._local.write_depth -= 1
+        self._write_lock.release()
+
+    def owns_write_lock(self):
+        # type: () -> bool
+        """Whether the current thread holds the write lock."""
+        return self._local.write_depth > 0
+
+    @contextmanager
+    def writing(self):
+        """Serialize writes, routing this thread's queries to the writer connection."""
+        self.lock_writes()
+        local = self._local
+        saved = local.conn, local.cursor
+        local.conn, local.cursor = self._conn, self._cursor
+        try:
+            yield self
+        finally:
+            local.conn, local.cursor = saved
+            self.release_write_lock()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block of writes, DDL included, in one explicit transaction of the writer connection,
+        committed if the block completes and rolled back otherwise.
+        (By default sqlite3 commits before each statement other than INSERT/UPDATE/DELETE.)
+        """
+        with self.writing():
+            conn = self._conn
+            conn.commit()
+            isolation_level, conn.isolation_level = conn.isolation_level, None
+            try:
+                self._cursor.execute('BEGIN')
+                try:
+                    yield self
+                except BaseException:
+                    self._cursor.execute('ROLLBACK')
+                    raise
+                self._cursor.execute('COMMIT')
+                with self._write_stats_lock:
+                    self.num_commits += 1
+            finally:
+                conn.isolation_level = isolation_level
+
+    def stats(self):
+        # type: () -> Dict[str, float]
+        stats = self.pool.stats()
+        with self._query_stats_lock:
+            stats.update(queries=self.num_queries)
+        with self._write_stats_lock:
+            stats.update(write_waits=self.num_write_waits, write_wait_time=self.write_wait_time,
+                         commits=self.num_commits)
+        return stats
 
     def __enter__(self):
         # type: () -> Database
@@ -63,5 +444,156 @@ class Database(object):
         self.release_lock()
 
     def reset_connection(self):
-        self.conn = sqlite3.connect(self.path)
-        self.cursor = self.conn.cursor()
+        self.pool.close()
+        self._conn = self._connect()
+        self._cursor = self.new_cursor(self._conn)
+
+
+class _PendingWrite(object):
+    """A write submitted to a `GroupCommitter`, done once its transaction is committed."""
+
+    def __init__(self, write, query_stats):
+        # type: (Callable[[], T], QueryStats | None) -> None
+        self.write = write
+        self.query_stats = query_stats  # of the submitting thread
+        self.result = None  # type: T
+        self.error = None  # type: Exception
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Background writer that runs concurrently submitted writes in shared transactions.
+
+    A transaction is committed once `size` writes are batched
+    or `interval` seconds have passed since the first one, whichever is first,
+    so many writes share one fsync.
+    Each write runs in its own savepoint, so a failing write only rolls back itself.
+    `submit()` returns only after the write has been committed.
+
+    Writes are functions of no arguments that write through `Database.cursor`,
+    which is the committer's own connection in the committer thread.
+    """
+
+    _STOP = object()
+
+    def __init__(self, database, interval=DEFAULT_GROUP_COMMIT_INTERVAL,
+                 size=DEFAULT_GROUP_COMMIT_SIZE):
+        # type: (Database, float, int) -> None
+        self._database = database
+        self.interval = interval
+        self.size = size
+        self._conn = database._connect()
+        self._conn.isolation_level = None  # transactions are managed explicitly
+        self._queue = Queue()  # type: Queue
+        self._stats_lock = threading.Lock()
+        self.num_commits = 0
+        self.num_writes = 0
+        self.commit_time = 0.0
+        self._thread = threading.Thread(target=self._run, name='GroupCommitter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, write):
+        # type: (Callable[[], T]) -> T
+        """
+        Run `write` in the next group transaction and return its result once committed.
+
+        A thread already holding the write lock (e.g. inside `Database.writing()`)
+        would deadlock waiting on the committer, which needs that lock,
+        so its write runs right away in the thread's own transaction instead,
+        which the thread commits or rolls back.
+        """
+        if self._database.owns_write_lock():
+            return write()
+        pending = _PendingWrite(write, self._database._local.query_stats)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _next_batch(self):
+        # type: () -> List[_PendingWrite]
+        batch = [self._queue.get()]
+        deadline = time() + self.interval
+        while len(batch) < self.size and batch[-1] is not self._STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+        return batch
+
+    def _run(self):
+        # type: () -> None
+        local = self._database._local
+        local.conn = self._conn
+        local.cursor = self._database.new_cursor(self._conn)
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit(batch)
+            if stop:
+                self._conn.close()
+                return
+
+    def _commit(self, batch):
+        # type: (List[_PendingWrite]) -> None
+        # transaction control goes through the connection, so only the writes are counted
+        execute = self._conn.execute
+        local = self._database._local
+        start = time()
+        self._database.lock_writes()
+        try:
+            execute('BEGIN IMMEDIATE')
+            for pending in batch:
+                execute('SAVEPOINT write')
+                local.query_stats = pending.query_stats
+                try:
+                    pending.result = pending.write()
+                except Exception as e:
+                    execute('ROLLBACK TO write')
+                    pending.error = e
+                finally:
+                    local.query_stats = None
+                execute('RELEASE write')
+            execute('COMMIT')
+        except Exception as e:
+            try:
+                execute('ROLLBACK')
+            except sqlite3.Error:
+                pass  # no transaction to roll back
+            for pending in batch:
+                pending.error = e
+        finally:
+            self._database.release_write_lock()
+        with self._stats_lock:
+            self.num_commits += 1
+            self.num_writes += len(batch)
+            self.commit_time += time() - start
+        for pending in batch:
+            pending.done.set()
+
+    def close(self):
+        # type: () -> None
+        """Commit all pending writes and stop the committer thread."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        with self._stats_lock:
+            return dict(
+                commits=self.num_commits,
+                writes=self.num_writes,
+                commit_time=self.commit_time,
+            )
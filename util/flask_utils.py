@@ -1,18 +1,36 @@
 from __future__ import print_function
 
+import os
 from functools import wraps
+from datetime import datetime
 from sys import stderr
+from time import time
 
 from flask import Flask
 from flask import Response
+from flask import current_app
+from flask import g
+from flask import make_response
 from flask import redirect
 from flask import request
 from flask import session
+from flask import stream_with_context
 from flask import url_for
+from werkzeug.http import is_resource_modified
 from typing import KeysView, List, Any, Dict, Set, Callable, Tuple, Type, Iterable
 
 from oop import extend
+from util.db import Database
 from util.flask_utils_types import Route, Router, Precondition
+from util.metrics import Histogram
+
+
+"""Session key of the args bound by reroute_to, by handle."""
+BOUND_ARGS_KEY = 'bound_args'
+"""Query parameter passing the handle of the bound args to the rerouted route."""
+BOUND_ARGS_HANDLE = 'bound'
+"""Maximum number of bound args kept in a session, in case some are never used."""
+MAX_BOUND_ARGS = 8
 
 
 def reroute_to(route_func, *args, **kwargs):
@@ -20,34 +38,142 @@ def reroute_to(route_func, *args, **kwargs):
     """
     Wrap redirect(url_for(...)) for route.func_name.
 
+    Any args and kwargs are kept in the session under a new handle
+    passed to the route in the URL, for bind_args to pass on.
+
     :param route_func: the route function to redirect to
     :return: the Response from redirect(url_for(route.func_name))
     """
     if args or kwargs:
-        session['args'] = args
-        session['kwargs'] = kwargs
+        handle = os.urandom(8).encode('hex')
+        bound_args = dict(session.get(BOUND_ARGS_KEY, {}))
+        if len(bound_args) >= MAX_BOUND_ARGS:
+            bound_args.clear()
+        bound_args[handle] = (args, kwargs)
+        session[BOUND_ARGS_KEY] = bound_args
+        return redirect(url_for(route_func.func_name, **{BOUND_ARGS_HANDLE: handle}))
     return redirect(url_for(route_func.func_name))
 
 
+"""Number of template chunks buffered into each chunk of a streamed response."""
+STREAM_BUFFER_SIZE = 64
+
+
+def stream_template(template_name, **context):
+    # type: (str, Dict[str, Any]) -> Response
+    """
+    Like render_template, but stream the rendered template in chunks,
+    so iterators in the context can be consumed lazily while the response is sent.
+    """
+    app = current_app  # type: Flask
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream))
+
+
+def with_validators(response, etag, last_modified=None):
+    # type: (Any, str, datetime | None) -> Response
+    """
+    Make a response with the given ETag and Last-Modified (naive UTC),
+    which clients may keep but must revalidate before each reuse.
+    """
+    response = make_response(response)  # type: Response
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    # type: (str, datetime | None) -> Response | None
+    """
+    A 304 Not Modified response if the request's If-None-Match or If-Modified-Since
+    show the client already has this version of the page, else None.
+    Only GET and HEAD requests are conditional.
+    """
+    if request.method not in ('GET', 'HEAD') \
+            or is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def track_queries(app, database):
+    # type: (Flask, Database) -> None
+    """
+    Collect the stats of the database queries of each request,
+    added as X-Query-Count and X-Query-Time (ms) headers in debug mode.
+
+    Streamed responses only include the queries run before streaming starts.
+    """
+
+    @app.before_request
+    def start_tracking():
+        database.start_tracking()
+
+    @app.after_request
+    def add_query_headers(response):
+        # type: (Response) -> Response
+        stats = database.stop_tracking()
+        if app.debug and stats is not None:
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time'] = '{:.3f}'.format(stats.time * 1000)
+        return response
+
+    @app.teardown_request
+    def stop_tracking(exception):
+        database.stop_tracking()  # in case the request failed before after_request
+
+
+def time_requests(app, histogram):
+    # type: (Flask, Histogram) -> None
+    """
+    Observe the seconds each request takes in `histogram`, labeled by route (endpoint).
+    Streamed responses are timed until streaming finishes.
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_start_time = time()
+
+    @app.teardown_request
+    def observe_request_time(exception):
+        start = getattr(g, 'request_start_time', None)
+        if start is not None:
+            histogram.labels(request.endpoint or 'unknown').observe(time() - start)
+
+
+def has_bound_args():
+    # type: () -> bool
+    """Assert the handle passed to the route refers to args bound by reroute_to."""
+    return request.args.get(BOUND_ARGS_HANDLE) in session.get(BOUND_ARGS_KEY, {})
+
+
 def bind_args(backup_route):
     # type: (Route) -> Router
     """
     Wrap a route that calls the original route
-    with args and kwargs passed through the session.
+    with the args and kwargs bound by reroute_to.
 
     backup_route is the route rerouted to
-    if the session doesn't contain args or kwargs.
+    if the handle of the args isn't passed or is unknown.
     """
 
     def binder(route_func):
         # type: (Callable[..., Response]) -> Route
-        @preconditions(backup_route, session_contains('args', 'kwargs'))
+        @preconditions(backup_route, has_bound_args)
         @wraps(route_func)
         def delegating_route():
             # type: () -> Response
-            print(session['args'])
-            print(session['kwargs'])
-            return route_func(*session.pop('args'), **session.pop('kwargs'))
+            bound_args = dict(session[BOUND_ARGS_KEY])
+            args, kwargs = bound_args.pop(request.args[BOUND_ARGS_HANDLE])
+            if bound_args:
+                session[BOUND_ARGS_KEY] = bound_args
+            else:
+                del session[BOUND_ARGS_KEY]
+            return route_func(*args, **kwargs)
 
         return delegating_route
 
@@ -237,6 +363,13 @@ def form_contains(*fields):
     return dict_contains(KeysViewSupplier(lambda: request.form), fields, form_contains)
 
 
+def values_contains(*fields):
+    # type: (List[str]) -> Precondition
+    """Assert request.values (the query string or form) contains all the given fields."""
+    return dict_contains(KeysViewSupplier(lambda: request.values.to_dict()), fields,
+                         values_contains)
+
+
 def session_contains(*keys):
     # type: (List[Any]) -> Precondition
     """Assert session contains all the given keys."""
@@ -0,0 +1,236 @@
+"""
+Minimal Prometheus-style metrics: counters, gauges and histograms, optionally labeled,
+collected in a `Registry` and rendered in the Prometheus text exposition format.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import time
+
+from typing import Callable, Dict, Iterable, List, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+"""Default histogram buckets (seconds), suited to request latencies."""
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _format_value(value):
+    # type: (float) -> str
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    # type: (Dict[str, str]) -> str
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, unicode(value).replace('\\', r'\\').replace('"', r'\"')
+                         .replace('\n', r'\n'))
+        for name, value in sorted(labels.viewitems())) + '}'
+
+
+class Registry(object):
+    """Metrics rendered together, e.g. by a /metrics route."""
+
+    def __init__(self):
+        self._metrics = []  # type: List[Metric]
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        # type: (Metric) -> None
+        with self._lock:
+            if any(other.name == metric.name for other in self._metrics):
+                raise ValueError('metric {} already registered'.format(metric.name))
+            self._metrics.append(metric)
+
+    def render(self):
+        # type: () -> str
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """
+    A metric, with a child per combination of label values,
+    or, if it has no labels, used directly.
+    """
+
+    type = None  # type: str
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        # type: (str, str, Iterable[str], Registry) -> None
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # type: Dict[Tuple[str, ...], object]
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._child = self.labels()
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child of the given label values, in the order of `labelnames`."""
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+        values = tuple(unicode(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def _labeled_children(self):
+        with self._lock:
+            children = list(self._children.viewitems())
+        return [(dict(zip(self.labelnames, values)), child) for values, child in children]
+
+    def samples(self):
+        # type: () -> Iterable[Sample]
+        for labels, child in self._labeled_children():
+            yield self.name, labels, child.value
+
+
+class _Value(object):
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        # type: (float) -> None
+        with self._lock:
+            self.value = value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        self._child.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        self._child.inc(amount)
+
+    def set(self, value):
+        # type: (float) -> None
+        self._child.set(value)
+
+
+class CallbackMetric(Metric):
+    """
+    An unlabeled metric whose value is read from `function` when rendered,
+    for stats kept elsewhere, like `Database.stats()`.
+    """
+
+    def __init__(self, name, documentation, function, type='gauge', registry=REGISTRY):
+        # type: (str, str, Callable[[], float], str, Registry) -> None
+        self.type = type
+        self._function = function
+        super(CallbackMetric, self).__init__(name, documentation, (), registry)
+
+    def _new_child(self):
+        return None
+
+    def samples(self):
+        # type: () -> Iterable[Sample]
+        yield self.name, {}, self._function()
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        # type: (Tuple[float, ...]) -> None
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # type: (float) -> None
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """Observe the seconds taken by the `with` block."""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        # type: (str, str, Iterable[str], Iterable[float], Registry) -> None
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        # type: (float) -> None
+        self._child.observe(value)
+
+    def time(self):
+        return self._child.time()
+
+    def samples(self):
+        # type: () -> Iterable[Sample]
+        for labels, child in self._labeled_children():
+            with child._lock:
+                counts, count, total = list(child.counts), child.count, child.sum
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield self.name + '_bucket', dict(labels, le='+Inf'), count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
@@ -4,9 +4,24 @@ from typing import List, NamedTuple, Dict
 
 all_namedtuples = {}  # type: Dict[str, type(NamedTuple)]
 
+"""Namedtuples given a tag, by tag, for `util.binary_codec`."""
+tagged_namedtuples = {}  # type: Dict[int, type(NamedTuple)]
 
-def namedtuple(typename, field_names, verbose=False, rename=False):
-    # type: (str, List[str]) -> type(NamedTuple)
+
+def namedtuple(typename, field_names, verbose=False, rename=False, tag=None):
+    # type: (str, List[str], bool, bool, int | None) -> type(NamedTuple)
+    """
+    Create and register a namedtuple type.
+
+    :param tag: small int, unique and stable across versions, identifying the type
+                in `util.binary_codec`'s encoding (None to not support encoding it)
+    """
     _type = collections.namedtuple(typename, field_names, verbose, rename)
     all_namedtuples[repr(_type)] = _type
+    if tag is not None:
+        if tag in tagged_namedtuples:
+            raise ValueError('namedtuple tag {} already used by {}'
+                             .format(tag, tagged_namedtuples[tag].__name__))
+        tagged_namedtuples[tag] = _type
+        _type._tag = tag
     return _type
@@ -0,0 +1,225 @@
+"""
+Server-side sessions: the session data stays in a `SessionStore`
+and the cookie only holds an opaque, random session id.
+"""
+
+import os
+import threading
+from time import time
+
+from flask import Flask
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from typing import Any, Dict, List, Tuple
+
+from util import binary_codec
+from util.db import Database
+
+"""Seconds a session lives after it was last saved."""
+DEFAULT_SESSION_TTL = 24 * 60 * 60
+"""Number of saves between purges of expired sessions."""
+PURGE_INTERVAL = 1000
+
+SessionData = Dict[str, Any]
+
+
+def new_session_id():
+    # type: () -> str
+    return os.urandom(16).encode('hex')
+
+
+class SessionStore(object):
+    """Session data by session id, each expiring `ttl` seconds after it was saved."""
+
+    def __init__(self, ttl=DEFAULT_SESSION_TTL):
+        # type: (float) -> None
+        self.ttl = ttl
+
+    def load(self, sid):
+        # type: (str) -> Tuple[SessionData, float] | None
+        """Load the data and expiry time of an unexpired session, or None."""
+        raise NotImplementedError
+
+    def save(self, sid, data):
+        # type: (str, SessionData) -> None
+        raise NotImplementedError
+
+    def delete(self, sid):
+        # type: (str) -> None
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions kept in this process, lost on restart."""
+
+    def __init__(self, ttl=DEFAULT_SESSION_TTL):
+        # type: (float) -> None
+        super(MemorySessionStore, self).__init__(ttl)
+        self._sessions = {}  # type: Dict[str, Tuple[SessionData, float]]
+        self._lock = threading.Lock()
+        self._num_saves = 0
+
+    def load(self, sid):
+        # type: (str) -> Tuple[SessionData, float] | None
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[1] < time():
+            return None
+        data, expires = entry
+        return dict(data), expires
+
+    def save(self, sid, data):
+        # type: (str, SessionData) -> None
+        with self._lock:
+            self._sessions[sid] = dict(data), time() + self.ttl
+            self._num_saves += 1
+            if self._num_saves % PURGE_INTERVAL == 0:
+                self._purge()
+
+    def _purge(self):
+        # type: () -> None
+        now = time()
+        expired = [sid for sid, (_, expires) in self._sessions.viewitems() if expires < now]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def delete(self, sid):
+        # type: (str) -> None
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+SESSIONS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions(
+        id TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        expires REAL NOT NULL
+    )'''
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Sessions persisted in an SQLite database, shared by processes using the same file.
+
+    `serializer` (with `dumps()` and `loads()`) encodes the data,
+    by default `util.binary_codec`.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_SESSION_TTL, serializer=binary_codec):
+        # type: (str, float, Any) -> None
+        super(SqliteSessionStore, self).__init__(ttl)
+        self.serializer = serializer
+        self.db = Database(path, wal=True)
+        self.db.cursor.execute(SESSIONS_SCHEMA)
+        self.db.cursor.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires)')
+        self.db.commit()
+        self._num_saves = 0
+
+    def load(self, sid):
+        # type: (str) -> Tuple[SessionData, float] | None
+        with self.db:
+            row = self.db.cursor.execute(
+                'SELECT data, expires FROM sessions WHERE id = ? AND expires >= ?',
+                [sid, time()]).fetchone()
+        if row is None:
+            return None
+        data, expires = row
+        return self.serializer.loads(str(data)), expires
+
+    def save(self, sid, data):
+        # type: (str, SessionData) -> None
+        encoded = buffer(self.serializer.dumps(data))
+        with self.db.writing():
+            cursor = self.db.cursor
+            cursor.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                           [sid, encoded, time() + self.ttl])
+            self._num_saves += 1
+            if self._num_saves % PURGE_INTERVAL == 0:
+                cursor.execute('DELETE FROM sessions WHERE expires < ?', [time()])
+            self.db.commit()
+
+    def delete(self, sid):
+        # type: (str) -> None
+        with self.db.writing():
+            self.db.cursor.execute('DELETE FROM sessions WHERE id = ?', [sid])
+            self.db.commit()
+
+    def close(self):
+        # type: () -> None
+        self.db.close()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, sid, initial=None, expires=None):
+        # type: (str, SessionData | None, float | None) -> None
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+        self.replaced_sids = []  # type: List[str]
+
+    def regenerate(self):
+        # type: () -> None
+        """
+        Move the session to a new session id, deleting the old one when saved,
+        so a session id known before a change of privilege (e.g. logging in) stops working.
+        """
+        self.replaced_sids.append(self.sid)
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface keeping sessions in `store`.
+
+    A session is saved when modified,
+    or, to keep it alive, when it's past half its lifetime.
+    """
+
+    session_class = ServerSideSession
+
+    def __init__(self, store):
+        # type: (SessionStore) -> None
+        self.store = store
+
+    def open_session(self, app, request):
+        # type: (Flask, Any) -> ServerSideSession
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            entry = self.store.load(sid)
+            if entry is not None:
+                data, expires = entry
+                return self.session_class(sid, data, expires)
+        return self.session_class(new_session_id())
+
+    def _needs_refresh(self, session):
+        # type: (ServerSideSession) -> bool
+        return session.expires is not None \
+            and session.expires - time() < self.store.ttl / 2.0
+
+    def save_session(self, app, session, response):
+        # type: (Flask, ServerSideSession, Any) -> None
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        for sid in session.replaced_sids:
+            self.store.delete(sid)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if not (session.modified or self._needs_refresh(session)):
+            return
+        self.store.save(session.sid, session)
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))